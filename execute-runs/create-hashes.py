@@ -1,61 +1,365 @@
 #!/usr/bin/env python3
 
 import os
-from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 import glob
 import json
-import mmap
+import random
+import sqlite3
 import sys
 import hashlib
-import multiprocessing as mp
 import subprocess
 import argparse
+import time
 
 import utils
 import _logging as logging
 
 
-def get_sha256_from_file(file_name):
-    def create_hash(content):
-        return hashlib.sha256(content).hexdigest()
+HASH_CHUNK_SIZE = 1024 * 1024
+"""Size of the chunks in which files are read for hashing."""
+
+HASH_BATCH_SIZE = 16 * 1024 * 1024
+"""Small files are hashed in batches of about this many bytes per task."""
+
+DEFAULT_WORKERS = min(8, len(os.sched_getaffinity(0)))
+"""Hashing is bound by the I/O of the shared results file system,
+so more threads than this only put more load on it."""
 
+
+def get_sha256_from_file(file_name):
     with open(file_name, "rb") as i:
-        try:
-            # map the file content into virtual memory and hash from there
-            # - this avoids unnecessary reads.
-            # cf. https://stackoverflow.com/a/62214783/3012884
-            with mmap.mmap(i.fileno(), 0, prot=mmap.PROT_READ) as mm:
-                return create_hash(mm)
-        except ValueError:
-            logging.debug(
-                "mmap can't map %s for hashing. Falling back to default read", file_name
-            )
-            return create_hash(i.read())
-
-
-def handle_file(i, root_dir):
-    if os.path.isdir(i):
-        return dict()
-    if utils.is_on_blacklist(i):
-        # We skip blacklisted files
-        logging.debug("Skipping blacklisted file %s", i)
-        return dict()
-    logging.debug("Hashing %s", i)
-    sha_hash = get_sha256_from_file(i)
-    file_path_for_map = os.path.relpath(i, start=root_dir)
-    return {file_path_for_map: sha_hash}
-
-
-def write_hashmap(output_file, directories, root_dir, target_file_glob):
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(i, "sha256").hexdigest()
+        sha256 = hashlib.sha256()
+        for chunk in iter(lambda: i.read(HASH_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+        return sha256.hexdigest()
+
+
+def _hash_batch(file_names):
+    return [get_sha256_from_file(f) for f in file_names]
+
+
+def _batch_files(files_with_sizes):
+    batch = list()
+    batch_size = 0
+    for file_name, size in files_with_sizes:
+        batch.append(file_name)
+        batch_size += size
+        if batch_size >= HASH_BATCH_SIZE:
+            yield batch
+            batch = list()
+            batch_size = 0
+    if batch:
+        yield batch
+
+
+def hash_files(files_with_sizes, workers=DEFAULT_WORKERS):
+    """Return the SHA-256 hashes of the given files, in the same order.
+
+    The files are hashed by a pool of threads, because hashlib releases the GIL
+    while it hashes. Small files are hashed in batches to reduce the overhead per task.
+
+    :param List[Tuple[str, int]] files_with_sizes: Files to hash, with their sizes.
+    :param int workers: Number of threads that hash in parallel.
+    """
+    if not files_with_sizes:
+        return list()
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        hashes = [
+            sha_hash
+            for batch_hashes in pool.map(_hash_batch, _batch_files(files_with_sizes))
+            for sha_hash in batch_hashes
+        ]
+    elapsed = max(time.monotonic() - start, 1e-6)
+    total_size = sum(size for _, size in files_with_sizes)
+    logging.info(
+        "Hashed %s file(s) (%.1f MB) in %.1f s: %.1f MB/s, %.1f files/s",
+        len(files_with_sizes),
+        total_size / 10**6,
+        elapsed,
+        total_size / 10**6 / elapsed,
+        len(files_with_sizes) / elapsed,
+    )
+    return hashes
+
+
+class HashCache:
+    """Persistent cache of file hashes, keyed by (st_dev, st_ino, st_size, st_mtime_ns).
+
+    A file is only re-hashed if one of these values changes.
+    The cache is backed by an SQLite database and must only be used
+    by the process that created it.
+    """
+
+    RACY_MTIME_NS = 2 * 10**9
+    """Files modified less than this time ago are not cached,
+    because a modification within the same mtime tick would go unnoticed."""
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self._connection = sqlite3.connect(cache_file, timeout=600)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS file_hashes "
+            "(dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, "
+            "sha256 TEXT NOT NULL, PRIMARY KEY (dev, ino, size, mtime_ns))"
+        )
+
+    @staticmethod
+    def _key(file_stat):
+        return (
+            file_stat.st_dev,
+            file_stat.st_ino,
+            file_stat.st_size,
+            file_stat.st_mtime_ns,
+        )
+
+    def get(self, file_stat):
+        row = self._connection.execute(
+            "SELECT sha256 FROM file_hashes "
+            "WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ?",
+            self._key(file_stat),
+        ).fetchone()
+        if row:
+            return row[0]
+        return None
+
+    def put(self, file_stat, sha_hash):
+        if time.time_ns() - file_stat.st_mtime_ns < self.RACY_MTIME_NS:
+            return
+        self._connection.execute(
+            "INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?, ?)",
+            self._key(file_stat) + (sha_hash,),
+        )
+
+    def commit(self):
+        self._connection.commit()
+
+    def close(self):
+        self._connection.commit()
+        self._connection.close()
+
+
+class HashStore:
+    """Indexed store of a hashmap (file path -> SHA-256 hash) in an SQLite database.
+
+    New entries are appended and checked for conflicts through the index,
+    so adding entries costs time proportional to the number of new entries,
+    not to the size of the hashmap. The legacy JSON hashmap is only written
+    on demand, with export_json. A generation counter is increased with every change
+    of the store, so that an unchanged store is not exported again.
+    """
+
+    def __init__(self, store_file):
+        self.store_file = store_file
+        self._connection = sqlite3.connect(store_file, timeout=600)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS hashes "
+            "(path TEXT PRIMARY KEY, sha256 TEXT NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS meta "
+            "(key TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+        )
+
+    def _get_meta(self, key):
+        row = self._connection.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)
+        ).fetchone()
+        if row:
+            return row[0]
+        return 0
+
+    def _set_meta(self, key, value):
+        self._connection.execute(
+            "INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value)
+        )
+
+    def __len__(self):
+        return self._connection.execute("SELECT COUNT(*) FROM hashes").fetchone()[0]
+
+    def get(self, path):
+        row = self._connection.execute(
+            "SELECT sha256 FROM hashes WHERE path = ?", (path,)
+        ).fetchone()
+        if row:
+            return row[0]
+        return None
+
+    def add(self, hashes):
+        """Add the given hashes to the store.
+
+        :raises AssertionError: if a path is already stored with a different hash.
+        """
+        changed = False
+        for path, sha_hash in hashes.items():
+            inserted = self._connection.execute(
+                "INSERT OR IGNORE INTO hashes VALUES (?, ?)", (path, sha_hash)
+            ).rowcount
+            changed = changed or bool(inserted)
+            if not inserted:
+                old_hash = self.get(path)
+                if old_hash != sha_hash:
+                    self._connection.rollback()
+                    raise AssertionError(
+                        "Duplicate key: %s and %s" % ((path, sha_hash), old_hash)
+                    )
+        if changed:
+            self._set_meta("generation", self._get_meta("generation") + 1)
+        self._connection.commit()
+
+    def items(self):
+        return self._connection.execute(
+            "SELECT path, sha256 FROM hashes ORDER BY rowid"
+        )
+
+    def is_exported(self, json_file):
+        """Return whether the given JSON file holds the current state of the store."""
+        generation = self._get_meta("generation")
+        return (
+            os.path.exists(json_file)
+            and self._get_meta("exported_generation") == generation
+        )
+
+    def export_json(self, json_file):
+        with open(json_file, "w+") as outp:
+            json.dump(dict(self.items()), outp, indent=utils.JSON_INDENT)
+        self._set_meta("exported_generation", self._get_meta("generation"))
+        self._connection.commit()
+
+    def close(self):
+        self._connection.close()
+
+
+def _group_by_inode(files):
+    """Return the given files grouped by their inode, as a dict
+    (st_dev, st_ino) -> (stat result, list of paths).
+    Hardlinks and symlinks to the same file end up in the same group.
+    """
+    files_by_inode = dict()
+    for i in files:
+        if os.path.isdir(i):
+            continue
+        if utils.is_on_blacklist(i):
+            # We skip blacklisted files
+            logging.debug("Skipping blacklisted file %s", i)
+            continue
+        file_stat = os.stat(i)
+        inode = (file_stat.st_dev, file_stat.st_ino)
+        if inode not in files_by_inode:
+            files_by_inode[inode] = (file_stat, list())
+        files_by_inode[inode][1].append(i)
+    return files_by_inode
+
+
+def _create_hashes(files, root_dir, workers, hash_cache=None, verify_sample=0):
+    """Create hashes for the given files and return them by path relative to root_dir.
+
+    Each inode is hashed only once and its hash is used for all its paths.
+    If a hash cache is given, only files that are not in the cache are hashed.
+    If verify_sample is greater than zero, that many randomly chosen files
+    with a cached hash are re-hashed, and mismatches are reported and corrected.
+    """
+    files_by_inode = _group_by_inode(files)
+    saved_size = sum(
+        file_stat.st_size * (len(paths) - 1)
+        for file_stat, paths in files_by_inode.values()
+    )
+    logging.info(
+        "Found %s file(s) with %s distinct inode(s), saving %.1f MB of hashing",
+        sum(len(paths) for _, paths in files_by_inode.values()),
+        len(files_by_inode),
+        saved_size / 10**6,
+    )
+
+    hashes = dict()
+
+    def _add_hash(paths, sha_hash):
+        for i in paths:
+            hashes[os.path.relpath(i, start=root_dir)] = sha_hash
+
+    cached = list()
+    uncached = list()
+    for file_stat, paths in files_by_inode.values():
+        sha_hash = None
+        if hash_cache is not None:
+            sha_hash = hash_cache.get(file_stat)
+        if sha_hash is None:
+            uncached.append((file_stat, paths))
+        else:
+            cached.append((file_stat, paths))
+            _add_hash(paths, sha_hash)
+
+    hashed = hash_files([(paths[0], st.st_size) for st, paths in uncached], workers)
+    for (file_stat, paths), sha_hash in zip(uncached, hashed):
+        if hash_cache is not None:
+            hash_cache.put(file_stat, sha_hash)
+        _add_hash(paths, sha_hash)
+    if hash_cache is None:
+        return hashes
+
+    hash_cache.commit()
+    logging.info(
+        "Hashed %s inode(s), took %s hash(es) from cache %s",
+        len(uncached),
+        len(cached),
+        hash_cache.cache_file,
+    )
+    if verify_sample > 0 and cached:
+        sample = random.sample(cached, min(verify_sample, len(cached)))
+        rehashed = hash_files([(paths[0], st.st_size) for st, paths in sample], workers)
+        mismatches = 0
+        for (file_stat, paths), sha_hash in zip(sample, rehashed):
+            cached_hash = hash_cache.get(file_stat)
+            if cached_hash != sha_hash:
+                mismatches += 1
+                logging.error(
+                    "Cached hash of %s is %s, but file has hash %s",
+                    paths[0],
+                    cached_hash,
+                    sha_hash,
+                )
+                hash_cache.put(file_stat, sha_hash)
+                _add_hash(paths, sha_hash)
+        hash_cache.commit()
+        logging.info(
+            "Verified %s cached hash(es), %s mismatch(es)", len(sample), mismatches
+        )
+    return hashes
+
+
+def write_hashmap(
+    output_file,
+    directories,
+    root_dir,
+    target_file_glob,
+    hash_cache=None,
+    verify_sample=0,
+    workers=DEFAULT_WORKERS,
+    hash_store=None,
+    export=True,
+):
     """Create a hashmap from the result files found in the given directory,
     and writes it to the output file.
     If the output file already exists, its values are merged with the newly created values.
 
+    If a hash store is given, the new values are added to the hash store instead,
+    and the output file is only written from the hash store if 'export' is set.
+    If the hash store is empty, it is initialized with the values of the output file.
+
     :param str outputfile: Name of the output file to write map into.
     :param List[str] directories: Path to the directories in which to look for result-files.
     :param str root_dir: Path to the directory that should be used as
              base directory for file links.
     :param str target_file_glob: Glob pattern for files to create hashes for.
+    :param HashCache hash_cache: Cache of file hashes. If given, only files
+             that are not in the cache are hashed.
+    :param int verify_sample: Number of cached hashes to verify by re-hashing.
+    :param int workers: Number of threads that hash files in parallel.
+    :param HashStore hash_store: Indexed store of the hashmap.
+    :param bool export: Whether to write the output file from the hash store.
     """
     hashes = dict()
     hashes_file = output_file
@@ -66,10 +370,13 @@ def write_hashmap(output_file, directories, root_dir, target_file_glob):
     # if it doesn't exist
     os.makedirs(hashes_dir, exist_ok=True)
     # Read all old hashmap values first
-    if os.path.exists(hashes_file):
+    if os.path.exists(hashes_file) and (hash_store is None or not len(hash_store)):
         with open(hashes_file) as inp:
             old_hashes = json.load(inp)
-        hashes.update(old_hashes)
+        if hash_store is None:
+            hashes.update(old_hashes)
+        else:
+            hash_store.add(old_hashes)
 
     for directory in directories:
         if not os.path.exists(directory):
@@ -79,25 +386,34 @@ def write_hashmap(output_file, directories, root_dir, target_file_glob):
         logging.info("  Processing files (write_hashmap) in %s ..." % directory)
         glob_pattern = directory + "/**/" + target_file_glob
         logging.debug("Globbing for %s", glob_pattern)
-        # Process pool that is used to create hashes for files in parallel.
-        # The given number defines the number of jobs that are run in parallel.
-        with mp.Pool(2) as process_pool:
-            individual_hash_dicts = process_pool.map(
-                partial(handle_file, root_dir=root_dir),
-                glob.iglob(glob_pattern, recursive=True),
-            )
-            for h in individual_hash_dicts:
-                assert all(k not in hashes or hashes[k] == v for k, v in h.items()), (
-                    "Duplicate key: %s and %s"
-                    % next(
-                        ((k, v), hashes[k])
-                        for k, v in h.items()
-                        if k in hashes and hashes[k] != v
-                    )
-                )
-                hashes.update(h)
-    with open(hashes_file, "w+") as outp:
-        json.dump(hashes, outp, indent=utils.JSON_INDENT)
+        new_hashes = _create_hashes(
+            glob.iglob(glob_pattern, recursive=True),
+            root_dir,
+            workers,
+            hash_cache,
+            verify_sample,
+        )
+        if hash_store is not None:
+            hash_store.add(new_hashes)
+            logging.info("Added hashes to %s", hash_store.store_file)
+            continue
+        assert all(
+            k not in hashes or hashes[k] == v for k, v in new_hashes.items()
+        ), "Duplicate key: %s and %s" % next(
+            ((k, v), hashes[k])
+            for k, v in new_hashes.items()
+            if k in hashes and hashes[k] != v
+        )
+        hashes.update(new_hashes)
+    if hash_store is None:
+        with open(hashes_file, "w+") as outp:
+            json.dump(hashes, outp, indent=utils.JSON_INDENT)
+    elif export and not hash_store.is_exported(hashes_file):
+        hash_store.export_json(hashes_file)
+    else:
+        if export:
+            logging.info("Hash store unchanged, not exporting %s", hashes_file)
+        return
     logging.info("Wrote hashes map to %s" % hashes_file)
     hashmap_dir = os.path.dirname(os.path.abspath(hashes_file))
     zip_dir = hashmap_dir + ".zip"
@@ -147,9 +463,61 @@ def parse(argv):
         default="*",
         help="glob pattern to use. If not given, all files in all subdirectories of the given directory are used.",
     )
-    parser.add_argument("dirs", nargs="+", help="list of folders to create hashes for")
+    parser.add_argument(
+        "--hash-cache",
+        dest="hash_cache",
+        action="store",
+        type=str,
+        default=None,
+        help="persistent cache of file hashes. Files are only hashed if their metadata"
+        " (device, inode, size, modification time) changed since they were cached.",
+    )
+    parser.add_argument(
+        "--verify",
+        dest="verify_sample",
+        action="store",
+        type=int,
+        default=0,
+        metavar="SAMPLE_SIZE",
+        help="re-hash a random sample of this many files with a cached hash"
+        " and report mismatches.",
+    )
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        action="store",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="number of threads that hash files in parallel (default: %(default)s).",
+    )
+    parser.add_argument(
+        "--store",
+        dest="store",
+        action="store",
+        type=str,
+        default=None,
+        help="indexed hash store to add the new hashes to. The output file is then"
+        " only written with --export. If the store is empty, it is initialized"
+        " with the content of the output file.",
+    )
+    parser.add_argument(
+        "--export",
+        dest="export",
+        action="store_true",
+        default=False,
+        help="write the output file from the hash store given with --store,"
+        " if the store changed since the last export.",
+    )
+    parser.add_argument("dirs", nargs="*", help="list of folders to create hashes for")
 
-    return parser.parse_args(argv)
+    args = parser.parse_args(argv)
+    if not args.dirs and not args.export:
+        parser.error("no folders given to create hashes for")
+    if args.export and not args.store:
+        parser.error("--export requires --store")
+    if args.verify_sample and not args.hash_cache:
+        parser.error("--verify requires --hash-cache")
+    return args
 
 
 def main(argv=None):
@@ -161,7 +529,29 @@ def main(argv=None):
     else:
         logging.init(logging.INFO, "create-hashes")
 
-    write_hashmap(args.output_path, args.dirs, args.root_dir, args.glob_pattern)
+    hash_cache = None
+    if args.hash_cache:
+        hash_cache = HashCache(args.hash_cache)
+    hash_store = None
+    if args.store:
+        hash_store = HashStore(args.store)
+    try:
+        write_hashmap(
+            args.output_path,
+            args.dirs,
+            args.root_dir,
+            args.glob_pattern,
+            hash_cache,
+            args.verify_sample,
+            args.workers,
+            hash_store,
+            args.export,
+        )
+    finally:
+        if hash_cache is not None:
+            hash_cache.close()
+        if hash_store is not None:
+            hash_store.close()
 
 
 if __name__ == "__main__":
@@ -13,6 +13,12 @@ WITNESSGLOBSUFFIX=$3;
 ROOT_DIR=$(realpath "$(dirname "$0")/../..")
 SCRIPTS_DIR=$(dirname "$0")
 HASHES_BASENAME="fileHashes.json"
+# Hashes of unchanged files are taken from this cache instead of re-hashing the files
+HASH_CACHE="$ROOT_DIR/fileHashesCache.sqlite"
+# New hashes are appended to this indexed store; the hashes map is exported from it.
+# The store only lives for the calls below, which belong to one result.
+HASH_STORE=$(mktemp --suffix=.fileHashes.sqlite)
+trap 'rm -f "$HASH_STORE"' EXIT
 
 if [[ "$LOG_DIR" == "" || "$WITNESSTARGET" == "" || "$WITNESSGLOBSUFFIX" == "" ]]; then
   echo "Usage: $0 <log directory> <witness name> <witness glob suffix>"
@@ -23,6 +29,8 @@ fi
 "$SCRIPTS_DIR"/create-hashes.py \
   -o "${LOG_DIR%.files}.$HASHES_BASENAME" \
   --root-dir "$ROOT_DIR" \
+  --hash-cache "$HASH_CACHE" \
+  --store "$HASH_STORE" \
   "$ROOT_DIR"/sv-benchmarks/c
 
 # Make sure that names of witnesses are always the same
@@ -35,6 +43,8 @@ fi
 "$SCRIPTS_DIR"/create-hashes.py \
   -o "${LOG_DIR%.files}.$HASHES_BASENAME" \
   --root-dir "$ROOT_DIR" \
+  --hash-cache "$HASH_CACHE" \
+  --store "$HASH_STORE" --export \
   "$LOG_DIR" \
   --glob "$WITNESSTARGET"
 
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+"""
+This script checks the integrity of a file store (e.g., directory `fileByHash`)
+and collects its garbage.
+
+Over a competition, the file store collects files that no current hashmap references
+(e.g., from reruns or removed results), and occasionally files whose content
+does not match their name.
+
+With `--verify`, all files of the store are re-hashed in parallel
+and files whose content does not match their hash are reported.
+The progress is stored in a state file, so that an interrupted verification
+continues where it stopped. With `--bandwidth-limit`, the verification reads at most
+the given number of MB per second, so that it can run alongside benchmarking.
+
+With `--sweep`, the hashes referenced by the given hashmaps (`*fileHashes.json*`)
+are marked as live, and all other files in the store are reported (`--sweep report`),
+moved to a quarantine directory (`--sweep quarantine`), or deleted (`--sweep delete`).
+
+Example usage:
+```
+prepare-tables/checkFileStore.py --verify --bandwidth-limit 50
+prepare-tables/checkFileStore.py --sweep quarantine results-verified/*fileHashes.json* results-validated/*fileHashes.json*
+```
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+import re
+import sys
+import threading
+import time
+
+import _logging as logging
+import utils
+
+FILE_STORE = "fileByHash"
+STATE_FILE = "checkFileStore.state"
+QUARANTINE_DIR = "fileByHash-quarantine"
+
+HASH_CHUNK_SIZE = 1024 * 1024
+PROGRESS_INTERVAL = 10
+"""Seconds between two progress reports."""
+
+_STORE_NAME = re.compile(r"^([0-9a-f]{64})(\..*)?$")
+
+
+class BandwidthLimiter:
+    """Limits the number of bytes read per second, across all threads."""
+
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = bytes_per_second
+        self._lock = threading.Lock()
+        self._next_slot = time.monotonic()
+
+    def acquire(self, size):
+        """Wait until the given number of bytes may be read."""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + size / self.bytes_per_second
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class Progress:
+    """Reports the progress of the verification regularly, with throughput and ETA."""
+
+    def __init__(self, total_files):
+        self.total_files = total_files
+        self.files = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._last_report = self._start
+
+    def update(self, size):
+        with self._lock:
+            self.files += 1
+            self.bytes += size
+            now = time.monotonic()
+            if now - self._last_report >= PROGRESS_INTERVAL:
+                self._last_report = now
+                self._report(now)
+
+    def _report(self, now):
+        elapsed = max(now - self._start, 1e-6)
+        remaining = (self.total_files - self.files) * elapsed / self.files
+        logging.info(
+            "Verified %s of %s file(s) (%.1f%%), %.1f MB/s, ETA %s",
+            self.files,
+            self.total_files,
+            100.0 * self.files / self.total_files,
+            self.bytes / 10**6 / elapsed,
+            time.strftime("%H:%M:%S", time.gmtime(remaining)),
+        )
+
+
+def get_hash(store_name):
+    """Return the hash of the given store entry, or None if it is no store entry."""
+    match = _STORE_NAME.match(store_name)
+    if not match:
+        return None
+    return match.group(1)
+
+
+def hash_file(file_name, limiter=None):
+    """Return the SHA-256 hash and the size of the given file."""
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(file_name, "rb") as inp:
+        for chunk in iter(lambda: inp.read(HASH_CHUNK_SIZE), b""):
+            if limiter:
+                limiter.acquire(len(chunk))
+            sha256.update(chunk)
+            size += len(chunk)
+    return sha256.hexdigest(), size
+
+
+def _read_state(state_file):
+    state = dict()
+    if os.path.exists(state_file):
+        with open(state_file) as inp:
+            for line in inp:
+                store_name, _, status = line.rstrip("\n").rpartition(" ")
+                if store_name:
+                    state[store_name] = status
+    return state
+
+
+def verify(store_dir, state_file, workers, limiter=None):
+    """Re-hash all files in the given store and report files whose content
+    does not match their hash. Files already verified according to the state file
+    are skipped, and each result is appended to the state file.
+
+    :return: list of the names of mismatching files.
+    """
+    state = _read_state(state_file)
+    mismatches = [n for n, status in state.items() if status == "mismatch"]
+    if state:
+        logging.info("Continuing verification: %s file(s) already verified", len(state))
+    entries = [
+        (store_name, store_path)
+        for store_name, store_path in utils.iter_store(store_dir)
+        if store_name not in state and get_hash(store_name)
+    ]
+    logging.info("Verifying %s file(s) in %s", len(entries), store_dir)
+    progress = Progress(len(entries))
+    state_lock = threading.Lock()
+
+    with open(state_file, "a") as state_out:
+
+        def _verify_entry(entry):
+            store_name, store_path = entry
+            try:
+                sha_hash, size = hash_file(store_path, limiter)
+            except FileNotFoundError:
+                # Removed since the store was listed
+                return
+            status = "ok" if sha_hash == get_hash(store_name) else "mismatch"
+            with state_lock:
+                if status == "mismatch":
+                    logging.error(
+                        "Content of %s does not match its name, hash is %s",
+                        store_path,
+                        sha_hash,
+                    )
+                    mismatches.append(store_name)
+                state_out.write(store_name + " " + status + "\n")
+                state_out.flush()
+            progress.update(size)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for _ in pool.map(_verify_entry, entries):
+                pass
+
+    logging.info(
+        "Verification of %s finished: %s mismatch(es)", store_dir, len(mismatches)
+    )
+    return mismatches
+
+
+def mark(hashmap_files):
+    """Return the set of all hashes referenced by the given hashmaps."""
+    live_hashes = set()
+    for hashmap_file in hashmap_files:
+        logging.debug("Marking hashes of %s", hashmap_file)
+        with utils.open_json(hashmap_file) as inp:
+            live_hashes.update(sha_hash for _, sha_hash in utils.iter_json_object(inp))
+    logging.info(
+        "Marked %s live hash(es) from %s hashmap(s)",
+        len(live_hashes),
+        len(hashmap_files),
+    )
+    return live_hashes
+
+
+def sweep(store_dir, live_hashes, mode, quarantine_dir=QUARANTINE_DIR):
+    """Report, quarantine or delete all entries of the given store
+    whose hash is not in the given live hashes.
+
+    :param str mode: One of 'report', 'quarantine' or 'delete'.
+    :return: list of the paths of unreferenced files.
+    """
+    garbage = [
+        store_path
+        for store_name, store_path in utils.iter_store(store_dir)
+        if get_hash(store_name) and get_hash(store_name) not in live_hashes
+    ]
+    garbage_size = 0
+    if mode == "quarantine":
+        os.makedirs(quarantine_dir, exist_ok=True)
+    for store_path in garbage:
+        garbage_size += os.path.getsize(store_path)
+        if mode == "report":
+            logging.info("Unreferenced: %s", store_path)
+        elif mode == "quarantine":
+            os.rename(
+                store_path, os.path.join(quarantine_dir, os.path.basename(store_path))
+            )
+        elif mode == "delete":
+            os.remove(store_path)
+    logging.info(
+        "%s %s unreferenced file(s) (%.1f MB) in %s",
+        {"report": "Found", "quarantine": "Quarantined", "delete": "Deleted"}[mode],
+        len(garbage),
+        garbage_size / 10**6,
+        store_dir,
+    )
+    return garbage
+
+
+def parse(argv):
+    parser = argparse.ArgumentParser(
+        description="Verify the integrity of a file store and collect its garbage."
+    )
+    parser.add_argument(
+        "--store",
+        dest="store_dir",
+        default=FILE_STORE,
+        help="file store to check. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        default=False,
+        help="re-hash all files of the store and report mismatches",
+    )
+    parser.add_argument(
+        "--state-file",
+        default=STATE_FILE,
+        help="file that stores the progress of the verification,"
+        " to continue an interrupted verification. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        default=False,
+        help="start the verification from scratch, ignoring the state file",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of threads that verify files in parallel. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--bandwidth-limit",
+        type=float,
+        default=None,
+        metavar="MB_PER_SECOND",
+        help="maximum number of MB read per second by the verification",
+    )
+    parser.add_argument(
+        "--sweep",
+        choices=["report", "quarantine", "delete"],
+        default=None,
+        help="report, quarantine or delete all files of the store"
+        " that are not referenced by the given hashmaps",
+    )
+    parser.add_argument(
+        "--quarantine-dir",
+        default=QUARANTINE_DIR,
+        help="directory to move unreferenced files to. Default: %(default)s",
+    )
+    parser.add_argument(
+        "hashmaps",
+        nargs="*",
+        help="all current hashmaps (*fileHashes.json*), required for --sweep",
+    )
+    args = parser.parse_args(argv)
+    if not args.verify and not args.sweep:
+        parser.error("one of --verify and --sweep is required")
+    if args.sweep and not args.hashmaps:
+        parser.error("--sweep requires the current hashmaps")
+    return args
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    args = parse(argv)
+    logging.init(logging.INFO, "check-file-store")
+
+    if not os.path.isdir(args.store_dir):
+        logging.error("File store %s does not exist", args.store_dir)
+        return 1
+
+    if args.verify:
+        if args.restart and os.path.exists(args.state_file):
+            os.remove(args.state_file)
+        limiter = None
+        if args.bandwidth_limit:
+            limiter = BandwidthLimiter(args.bandwidth_limit * 10**6)
+        mismatches = verify(args.store_dir, args.state_file, args.workers, limiter)
+    if args.sweep:
+        live_hashes = mark(args.hashmaps)
+        sweep(args.store_dir, live_hashes, args.sweep, args.quarantine_dir)
+    if args.verify and mismatches:
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+This script migrates a file store (e.g., directory `fileByHash`)
+from the flat layout to the sharded layout.
+
+In the flat layout, all files are stored in one directory as `<hash>.<suffix>`.
+With millions of entries, lookups, directory walks and rsync of that directory get slow.
+In the sharded layout, files are stored as `ab/cd/<hash>.<suffix>`,
+where `ab` and `cd` are the first two pairs of characters of the hash.
+
+The files are moved, not copied. The store is marked as sharded first,
+so that an interrupted migration can be continued and the scripts that read
+the store already find files in both layouts.
+The migration also adds a `.htaccess` file to the store that rewrites
+published URLs of the flat layout to the sharded layout.
+
+Example usage:
+```
+prepare-tables/migrateFileStore.py fileByHash
+```
+"""
+
+import argparse
+import os
+import sys
+
+import _logging as logging
+import utils
+
+
+def migrate(store_dir):
+    utils.mark_sharded_store(store_dir)
+    store_names = [
+        entry.name
+        for entry in os.scandir(store_dir)
+        if entry.is_file(follow_symlinks=False) and not entry.name.startswith(".")
+    ]
+    logging.info("Moving %s file(s) to the sharded layout.", len(store_names))
+    shard_dirs = set()
+    for count, store_name in enumerate(store_names, start=1):
+        target = os.path.join(store_dir, utils.get_store_path(store_name, True))
+        shard_dir = os.path.dirname(target)
+        if shard_dir not in shard_dirs:
+            os.makedirs(shard_dir, exist_ok=True)
+            shard_dirs.add(shard_dir)
+        os.rename(os.path.join(store_dir, store_name), target)
+        if count % 100000 == 0:
+            logging.info("Moved %s of %s file(s).", count, len(store_names))
+    logging.info("Migration of %s finished.", store_dir)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    parser = argparse.ArgumentParser(
+        description="Migrate a file store to the sharded layout."
+    )
+    parser.add_argument("store_dir", help="file store to migrate")
+    args = parser.parse_args(argv)
+    logging.init(logging.INFO, "migrate-file-store")
+
+    if not os.path.isdir(args.store_dir):
+        logging.error("File store %s does not exist", args.store_dir)
+        return 1
+    migrate(args.store_dir)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,56 +6,59 @@ import sys
 import _logging as logging
 import argparse
 import functools
-import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 
 import utils
 
 
-def link_file(f, sha_hash, root_dir, store_dir):
-    source, by_hash_file = get_source_and_target(f, sha_hash, root_dir, store_dir)
-    try:
-        os.link(source, by_hash_file)
-        logging.debug("Linked %s to %s", source, by_hash_file)
-    except FileExistsError as e:
-        # assert os.path.exists(by_hash_file), "File exists but is broken link. This should be handled"
-        logging.debug("Skipping %s, already exists", by_hash_file)
-    except FileNotFoundError as e:
-        logging.warning(
-            "File from hashmap does not exist, not adding it to file store: %s",
-            source,
-        )
-
-
-def get_source_and_target(f, sha_hash, root_dir, store_dir):
-    if utils.is_on_blacklist(f):
-        logging.debug("%s on blacklist, not adding to file hash", f)
-        return
-
-    # assert not os.path.isabs(f)
-    source = os.path.realpath(os.path.join(root_dir, f))
+LINK_WORKERS = 8
+"""Number of threads that create links in parallel."""
+
+
+def get_store_name(f, sha_hash):
+    """Return the name of the given file in the file store."""
     try:
         file_suffix = os.path.basename(f).rsplit(".")[1]
-        target = os.path.join(store_dir, sha_hash + "." + file_suffix)
+        return sha_hash + "." + file_suffix
     except IndexError:
-        target = os.path.join(store_dir, sha_hash)
-    return source, target
+        return sha_hash
 
 
-def create_store(by_hash_dir, root_dir, *hash_files):
-    """Create, for each entry in the given hashmap, a file $by_hash_dir/$hash.$file_suffix.
+def _link_file(sources, target, root_fd, store_fd):
+    """Link the first existing source (relative to root_fd)
+    to target (relative to store_fd).
 
-    :param str by_hash_dir: Path to the directory into which to put hashed files.
-    :param str root_dir: Path to the directory that should be used as
-             base directory for file links.
-    :param str hashes_file: JSON files that contains hashes that should be processed.
+    :return str: 'linked', 'skipped' or 'missing'
     """
-    if not os.path.exists(by_hash_dir):
-        os.mkdir(by_hash_dir)
-        logging.debug("%s created", by_hash_dir)
+    for source in sources:
+        try:
+            os.link(
+                source,
+                target,
+                src_dir_fd=root_fd,
+                dst_dir_fd=store_fd,
+                follow_symlinks=True,
+            )
+            logging.debug("Linked %s to %s", source, target)
+            return "linked"
+        except FileExistsError as e:
+            # Created concurrently since the store was listed
+            logging.debug("Skipping %s, already exists", target)
+            return "skipped"
+        except FileNotFoundError as e:
+            # Try the next file with the same hash
+            logging.debug("%s does not exist", source)
+    logging.warning(
+        "No file from hashmap exists, not adding it to file store: %s",
+        ", ".join(sources),
+    )
+    return "missing"
 
-    root_dir = os.path.abspath(root_dir)
 
-    link = functools.partial(link_file, root_dir=root_dir, store_dir=by_hash_dir)
+def _get_links_to_create(hash_files, stored_files, counters):
+    """Return a dict that maps each missing file-store entry to the list of
+    its source files, for all given hashes files."""
+    links = dict()
     for hashes_file in hash_files:
         logging.debug("Considering %s", hashes_file)
         try:
@@ -65,8 +68,78 @@ def create_store(by_hash_dir, root_dir, *hash_files):
             logging.error("Error loading %s: %s", hashes_file, e)
             continue
 
-        with multiprocessing.Pool(processes=4) as pool:
-            pool.starmap(link, hashmap.items())
+        for f, sha_hash in hashmap.items():
+            if utils.is_on_blacklist(f):
+                logging.debug("%s on blacklist, not adding to file hash", f)
+                continue
+            target = get_store_name(f, sha_hash)
+            if target in stored_files:
+                counters["skipped"] += 1
+            else:
+                links.setdefault(target, []).append(f)
+    return links
+
+
+def create_store(by_hash_dir, root_dir, *hash_files, sharded=False):
+    """Create, for each entry in the given hashmap, a file $by_hash_dir/$hash.$file_suffix.
+
+    If sharded is set or the store already uses the sharded layout,
+    the file is created as $by_hash_dir/ab/cd/$hash.$file_suffix instead
+    (cf. utils.get_store_path).
+
+    The store directory is listed once, and only entries that are not in the store yet
+    are linked, by a pool of threads, for all hashes files at once.
+    Links are created relative to open directory descriptors of the root and the store.
+
+    :param str by_hash_dir: Path to the directory into which to put hashed files.
+    :param str root_dir: Path to the directory that should be used as
+             base directory for file links.
+    :param str hashes_file: JSON files that contains hashes that should be processed.
+    :param bool sharded: Whether to use the sharded layout for a new store.
+    :return dict: number of 'linked', 'skipped' (already stored) and 'missing' entries.
+    """
+    if not os.path.exists(by_hash_dir):
+        os.mkdir(by_hash_dir)
+        logging.debug("%s created", by_hash_dir)
+
+    if utils.is_sharded_store(by_hash_dir):
+        sharded = True
+    elif sharded:
+        if os.listdir(by_hash_dir):
+            raise ValueError(
+                "File store %s uses the flat layout, "
+                "migrate it with migrateFileStore.py" % by_hash_dir
+            )
+        utils.mark_sharded_store(by_hash_dir)
+
+    counters = {"linked": 0, "skipped": 0, "missing": 0}
+    stored_files = utils.list_store(by_hash_dir)
+    links = _get_links_to_create(hash_files, stored_files, counters)
+    targets = [utils.get_store_path(target, sharded) for target in links.keys()]
+    for shard_dir in {os.path.dirname(target) for target in targets} - {""}:
+        os.makedirs(os.path.join(by_hash_dir, shard_dir), exist_ok=True)
+
+    root_fd = os.open(root_dir, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        store_fd = os.open(by_hash_dir, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            link = functools.partial(_link_file, root_fd=root_fd, store_fd=store_fd)
+            with ThreadPoolExecutor(max_workers=LINK_WORKERS) as pool:
+                for result in pool.map(link, links.values(), targets):
+                    counters[result] += 1
+        finally:
+            os.close(store_fd)
+    finally:
+        os.close(root_fd)
+
+    logging.info(
+        "File store %s: %s linked, %s skipped (already stored), %s missing",
+        by_hash_dir,
+        counters["linked"],
+        counters["skipped"],
+        counters["missing"],
+    )
+    return counters
 
 
 def parse(argv):
@@ -96,6 +169,15 @@ def parse(argv):
         required=True,
         help="base directory to use for relative paths in hashes.json",
     )
+    parser.add_argument(
+        "--sharded",
+        dest="sharded",
+        action="store_true",
+        default=False,
+        help="create a new store with the sharded layout"
+        " $hash[0:2]/$hash[2:4]/$hash.$suffix."
+        " Stores that already use the sharded layout are always extended with it.",
+    )
     parser.add_argument(
         "files", nargs="+", help="list of json files to create store for"
     )
@@ -112,7 +194,11 @@ def main(argv=None):
     else:
         logging.init(logging.INFO, "create-store")
 
-    create_store(args.store_dir, args.root_dir, *args.files)
+    try:
+        create_store(args.store_dir, args.root_dir, *args.files, sharded=args.sharded)
+    except ValueError as e:
+        logging.error("%s", e)
+        return 1
 
 
 if __name__ == "__main__":
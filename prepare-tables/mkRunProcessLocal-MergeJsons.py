@@ -9,22 +9,42 @@ import _logging as logging
 
 
 def _merge_hashmaps(*files):
+    """Merge the given hashmap files in one pass and return the union.
+
+    The files are streamed entry by entry. Keys that occur in multiple files
+    are expected (e.g., the program files), but if their values differ,
+    the key is reported as conflict. The value of the last file is kept.
+
+    :return: tuple (hashmap_union, conflicts), where conflicts is a dict
+             that maps each conflicting key to the list of its values.
+    """
     hashmap_union = dict()
+    conflicts = dict()
     for hashmap_file in files:
-        with open(hashmap_file) as inp:
-            curr_hashmap = json.load(inp)
-            # This always fails because of the program files
-            # for k in curr_hashmap:
-            #    assert k not in hashmap_union, "Key already exists: %s" % k
-            hashmap_union.update(curr_hashmap)
-    return hashmap_union
+        logging.debug("Merging %s", hashmap_file)
+        with utils.open_json(hashmap_file) as inp:
+            for k, v in utils.iter_json_object(inp):
+                old_v = hashmap_union.get(k, v)
+                hashmap_union[k] = v
+                if old_v != v:
+                    conflicts.setdefault(k, [old_v])
+                    if v not in conflicts[k]:
+                        conflicts[k].append(v)
+    return hashmap_union, conflicts
 
 
-def merge_hashmaps(output_file, *files):
-    hashmap_union = _merge_hashmaps(*files)
+def merge_hashmaps(output_file, *files, compact=False):
+    hashmap_union, conflicts = _merge_hashmaps(*files)
+    for k, values in conflicts.items():
+        logging.warning("Conflicting values for key %s: %s", k, values)
+    if conflicts:
+        logging.warning("%s conflicting key(s), kept the last value", len(conflicts))
     hashmap_file = output_file
-    with open(hashmap_file, "w+") as outp:
-        json.dump(hashmap_union, outp, indent=utils.JSON_INDENT)
+    with utils.open_json(hashmap_file, "wt") as outp:
+        if compact:
+            json.dump(hashmap_union, outp, separators=(",", ":"))
+        else:
+            json.dump(hashmap_union, outp, indent=utils.JSON_INDENT)
     logging.info("Wrote hashmap to %s", hashmap_file)
 
 
@@ -45,9 +65,20 @@ def parse(argv):
         action="store",
         type=str,
         required=True,
-        help="output file to write result json into.",
+        help="output file to write result json into. Written gzip-compressed if it ends with '.gz'.",
+    )
+    parser.add_argument(
+        "--compact",
+        dest="compact",
+        action="store_true",
+        default=False,
+        help="write the result json without indentation and whitespace",
+    )
+    parser.add_argument(
+        "files",
+        nargs="+",
+        help="list of json files to merge. Files ending with '.gz' are read gzip-compressed.",
     )
-    parser.add_argument("files", nargs="+", help="list of json files to merge")
 
     return parser.parse_args(argv)
 
@@ -61,7 +92,7 @@ def main(argv=None):
     else:
         logging.init(logging.INFO, "merge-jsons")
 
-    merge_hashmaps(args.output_path, *args.files)
+    merge_hashmaps(args.output_path, *args.files, compact=args.compact)
 
 
 if __name__ == "__main__":
@@ -4,57 +4,7 @@ import argparse
 import os
 import json
 import _logging as logging
-
-
-def _replace_data_json(file_name: str, data_rows: dict) -> str:
-    new_content = list()
-    in_data_def = False
-    json_str = json.dumps(data_rows, sort_keys=True)
-    assert json_str[0] == "{", "json str starts with {}".format(json_str[:20])
-    assert json_str[-1] == "}", "json str stops with {}".format(json_str[-20:])
-    json_str = "{\n" + json_str[1:-1] + "\n};\n"
-    with open(file_name, "r") as inp:
-        for line in inp.readlines():
-            if line.startswith("const data = {"):
-                in_data_def = True
-                new_line = "const data = " + json_str
-                new_content.append(new_line)
-
-            if not in_data_def:
-                new_content.append(line)
-            elif line.startswith("}"):
-                in_data_def = False
-    return "".join(new_content)
-
-
-def _get_data_json(file_name: str) -> dict:
-    # This method gets the data json from the html
-    # through simple pattern matching.
-    # After the start of the expected data json is found in the given file,
-    # every line is considered until a line starting with '}' is encountered.
-    # If one of the considered lines starts with "const data = {"
-    # the object starting with '{' at the end of that line is read and returned
-    # until a line starting with '}' is encountered. This is then considered the end
-    # of the data object.
-    # If the table generator changes that expected structure,
-    # it must be adjusted here.
-    in_data_def = False
-    with open(file_name, "r") as inp:
-        relevant_lines = list()
-        for line in inp.readlines():
-            if line.startswith("const data = {"):
-                in_data_def = True
-                relevant_lines.append("{")
-            elif in_data_def:
-                if line.startswith("}"):
-                    in_data_def = False
-                    relevant_lines.append("}")
-                    break
-                else:
-                    relevant_lines.append(line)
-        if relevant_lines:
-            return json.loads("".join(relevant_lines))
-        return None
+import utils
 
 
 # Only execute automatically if called from command line.
@@ -70,6 +20,32 @@ if __name__ == "__main__":
         action="store_true",
         help="replace files in-place. New file content will be written to $file.new, otherwise",
     )
+    parser.add_argument(
+        "--external-data",
+        dest="external_data",
+        action="store_true",
+        help="move the table data into a separate, content-addressed and compressed"
+        " JSON file in directory '%s' next to the table."
+        " The table then needs a web server that serves the compressed file"
+        " (configured by the .htaccess in that directory),"
+        " and cannot be opened from the local file system" % utils.TABLE_DATA_DIR,
+    )
+    parser.add_argument(
+        "--compress",
+        dest="compress",
+        action="store_true",
+        help="write the new file content gzip-compressed to $file.gz (or $file.new.gz)"
+        " and, with --insitu, remove $file."
+        " Files with suffix .gz are always read and written compressed",
+    )
+    parser.add_argument(
+        "--compression-level",
+        dest="compression_level",
+        type=int,
+        choices=range(1, 10),
+        default=9,
+        help="gzip compression level for compressed files. Default: %(default)s",
+    )
     args = parser.parse_args()
 
     logging.init(logging.DEBUG, "create-hashes")
@@ -80,19 +56,24 @@ if __name__ == "__main__":
             continue
 
         try:
-            data_json = _get_data_json(filename)
+            data_json = utils.get_data_json(filename)
             new_stats = list()
             for stat in data_json["stats"]:
                 if stat["id"] != "score":
                     new_stats.append(stat)
             data_json["stats"] = new_stats
-            new_html = _replace_data_json(filename, data_json)
+            new_html = utils.replace_data_json(filename, data_json, args.external_data)
             if args.replace_files:
                 new_filename = filename
+            elif filename.endswith(".gz"):
+                new_filename = filename[: -len(".gz")] + ".new.gz"
             else:
                 new_filename = filename + ".new"
-            with open(new_filename, "w") as file_out:
-                file_out.write(new_html)
+            if args.compress:
+                new_filename = utils.compressed_table_name(new_filename)
+            utils.write_table(new_filename, new_html, args.compression_level)
+            if args.replace_files and new_filename != filename:
+                os.remove(filename)
 
         except json.JSONDecodeError as e:
             logging.warning("File %s not parseable, skipping it: %s", filename, e)
@@ -2,13 +2,14 @@
 
 import sys
 import argparse
+import collections
 import os
 import urllib.parse
 import re
-import zipfile
 import json
 import multiprocessing as mp
 import functools
+from concurrent.futures import ThreadPoolExecutor
 import _logging as logging
 import io
 import base64
@@ -28,8 +29,9 @@ except ModuleNotFoundError:
 FILE_STORE = "fileByHash"
 FILE_STORE_URL_PREFIX = ""
 
-COVERAGE_SEQ_NAME = "results.json"
-COV_ACCUMULATED = "Coverage (accumulated)"
+TESTSUITE_INFO_CACHE = None
+EXISTENCE_INDEX = None
+
 MAX_COVERAGE = (
     100  # change this to 1 if coverage is expressed in 0.0--1.0 instead of percent
 )
@@ -93,6 +95,68 @@ def get_inputfile_paths(task_definition_yml) -> List[str]:
     return input_files
 
 
+class ExistenceIndex:
+    """In-memory index of existing files, for existence checks without disk access.
+
+    The index consists of the files in the hashmap, of one listing of each directory
+    that contains such a file, and of one listing of the file store
+    (in flat or sharded layout). A file exists if it is in the hashmap
+    and in the listing of its directory, so files of the hashmap that were removed
+    since hashing do not exist.
+    If 'strict' is set, all existence checks are done on disk, one by one.
+    """
+
+    def __init__(self, file_to_hash, file_store=FILE_STORE, strict=False):
+        self.strict = strict
+        self.file_store = file_store
+        self.sharded = utils.is_sharded_store(file_store)
+        self._files = file_to_hash
+        self._dir_listings = dict()
+        self._store_files = utils.list_store(file_store)
+
+    def _list_dir(self, directory):
+        if directory not in self._dir_listings:
+            try:
+                self._dir_listings[directory] = set(os.listdir(directory or "."))
+            except (FileNotFoundError, NotADirectoryError):
+                self._dir_listings[directory] = set()
+        return self._dir_listings[directory]
+
+    def exists(self, file_name) -> bool:
+        if self.strict:
+            return os.path.exists(file_name)
+        if file_name not in self._files:
+            return False
+        directory, basename = os.path.split(os.path.normpath(file_name))
+        return basename in self._list_dir(directory)
+
+    def exists_in_store(self, store_file_name) -> bool:
+        if self.strict:
+            store_path = utils.get_store_path(store_file_name, self.sharded)
+            return os.path.exists(os.path.join(self.file_store, store_path))
+        return store_file_name in self._store_files
+
+
+def _exists(file_name) -> bool:
+    if EXISTENCE_INDEX is None:
+        return os.path.exists(file_name)
+    return EXISTENCE_INDEX.exists(file_name)
+
+
+def _exists_in_store(store_file_name) -> bool:
+    if EXISTENCE_INDEX is None:
+        return utils.resolve_store_file(FILE_STORE, store_file_name) is not None
+    return EXISTENCE_INDEX.exists_in_store(store_file_name)
+
+
+def _get_store_path(store_file_name) -> str:
+    if EXISTENCE_INDEX is None:
+        sharded = utils.is_sharded_store(FILE_STORE)
+    else:
+        sharded = EXISTENCE_INDEX.sharded
+    return FILE_STORE + "/" + utils.get_store_path(store_file_name, sharded)
+
+
 def preg_match(pattern, text):
     return re.search(pattern, text) is not None
 
@@ -101,63 +165,97 @@ def preg_replace(pattern, replace_with, text):
     return re.sub(pattern, replace_with, text)
 
 
+_PARENT_DIR_PATTERN = re.compile(r"^\.\./")
+_LOGFILES_PATTERN = re.compile(r"\.logfiles")
+
+
+@functools.lru_cache(maxsize=None)
+def _witness_tag_pattern(tag):
+    return re.compile("^.*___" + tag + "___(.*)$")
+
+
 def get_witness_name(tag, line):
-    witness_name = preg_replace("^.*___" + tag + "___(.*)$", "\\1", line.strip())
-    witness_name = preg_replace("^\.\.\/", "", witness_name)
-    witness_name = preg_replace("\.logfiles", ".files", witness_name)
+    witness_name = _witness_tag_pattern(tag).sub("\\1", line.strip())
+    witness_name = _PARENT_DIR_PATTERN.sub("", witness_name)
+    witness_name = _LOGFILES_PATTERN.sub(".files", witness_name)
     return urllib.parse.unquote(witness_name)
 
 
-def make_url(line, task_def_name, tag, service, file_to_hash):
+def make_url(
+    line, task_def_name, tag, service, file_to_hash, url_cache=None, query_cache=None
+):
+    """Return the URL of the given witness-based-debugging service for a witness.
+
+    If dictionaries 'url_cache' and 'query_cache' are given, they are used
+    to memoize the URLs and their queries, so that the same (program, witness) pair
+    is only resolved once for all services.
+    """
+    if url_cache is None:
+        url_cache = dict()
+    if query_cache is None:
+        query_cache = dict()
+    witness_name = get_witness_name(tag, line)
+    key = (task_def_name, witness_name, service)
+    if key not in url_cache:
+        data = _get_url_query(task_def_name, witness_name, file_to_hash, query_cache)
+        if data is None:
+            url_cache[key] = ""
+        else:
+            url_components = [
+                "https",  # scheme
+                "www.sosy-lab.org",  # address
+                "/research/witness-based-debugging/{}.php".format(service),  # directory
+                "",  # parameters
+                data,  # query components (GET-attributes)
+                "",
+            ]  # fragment identifier
+            url_cache[key] = urllib.parse.urlunparse(url_components)
+    return url_cache[key]
+
+
+@functools.lru_cache(maxsize=1024)
+def _get_input_program(task_def_name):
     input_files = get_inputfile_paths(task_def_name)
-    if input_files is None:
-        return ""
-    if len(input_files) != 1:
+    if input_files is not None and len(input_files) != 1:
         logging.debug(
             "Task %s  has multiple or no input files. We currently can't handle this. Input files: %s",
             task_def_name,
             input_files,
         )
-        return ""
-    input_program_name = input_files[0]
-    witness_name = get_witness_name(tag, line)
-    # print(witness_name)
-    # print(input_program_name)
+        input_files = None
+    return input_files[0] if input_files else None
 
-    input_program_sha256 = ""
-    if os.path.exists(input_program_name):
-        input_program_sha256 = file_to_hash[input_program_name]
 
-    witness_sha256 = "0" * 64
-    if os.path.exists(witness_name):
-        witness_sha256 = file_to_hash[witness_name]
+def _get_url_query(task_def_name, witness_name, file_to_hash, query_cache):
+    key = (task_def_name, witness_name)
+    if key not in query_cache:
+        input_program_name = _get_input_program(task_def_name)
+        if input_program_name is None:
+            query_cache[key] = None
+            return None
 
-    parameters = [
-        ("programSHA256", input_program_sha256),
-        ("programName", input_program_name),
-        ("witnessSHA256", witness_sha256),
-        ("witnessName", witness_name),
-    ]  # Use a list so that the key-value pairs are always in the same order
+        input_program_sha256 = ""
+        if _exists(input_program_name):
+            input_program_sha256 = file_to_hash[input_program_name]
 
-    data = urllib.parse.urlencode(parameters)
+        witness_sha256 = "0" * 64
+        if _exists(witness_name):
+            witness_sha256 = file_to_hash[witness_name]
 
-    url_components = [
-        "https",  # scheme
-        "www.sosy-lab.org",  # address
-        "/research/witness-based-debugging/{}.php".format(service),  # directory
-        "",  # parameters
-        data,  # query components (GET-attributes)
-        "",
-    ]  # fragment identifier
+        parameters = [
+            ("programSHA256", input_program_sha256),
+            ("programName", input_program_name),
+            ("witnessSHA256", witness_sha256),
+            ("witnessName", witness_name),
+        ]  # Use a list so that the key-value pairs are always in the same order
 
-    url = urllib.parse.urlunparse(url_components)
-    # print('{}'.format(url))
-    return url
+        query_cache[key] = urllib.parse.urlencode(parameters)
+    return query_cache[key]
 
 
 def make_url_string(file_name, file_to_hash):
     urlstring = "---"
-    if os.path.exists(file_name):
+    if _exists(file_name):
         assert file_name in file_to_hash, "{} not in hashmap".format(file_name)
         file_sha256 = file_to_hash[file_name]
         assert file_sha256
@@ -165,9 +263,10 @@ def make_url_string(file_name, file_to_hash):
         file_suffix = ""
         if "." in basename:
             file_suffix = "." + basename.split(".")[-1]
-        file_store_file_name = FILE_STORE + "/" + file_sha256 + file_suffix
+        store_file_name = file_sha256 + file_suffix
+        file_store_file_name = _get_store_path(store_file_name)
         urlstring = FILE_STORE_URL_PREFIX + file_store_file_name
-        if not os.path.exists(file_store_file_name):
+        if not _exists_in_store(store_file_name):
             logging.warning(
                 "File does not exist in store for %s, creating invalid URL: %s",
                 file_name,
@@ -182,18 +281,34 @@ def make_url_wit(line, tag, service, file_to_hash):
     return make_url_string(witness_name, file_to_hash)
 
 
-def make_value_size(line, tag, service):
+def _get_testsuite_info(testsuite_file, file_to_hash):
+    if not _exists(testsuite_file):
+        return None
+    try:
+        return TESTSUITE_INFO_CACHE.get(
+            testsuite_file, file_to_hash.get(testsuite_file)
+        )
+    except FileNotFoundError:
+        # Removed since the index was built
+        logging.warning("Test suite %s does not exist", testsuite_file)
+        return None
+
+
+def make_value_size(line, tag, service, file_to_hash):
     witness_name = get_witness_name(tag, line)
-    test_count = utils.get_file_number_in_zip(witness_name)
-    return test_count
+    testsuite_info = _get_testsuite_info(witness_name, file_to_hash)
+    if testsuite_info is None:
+        return 0
+    return testsuite_info.number_of_tests
 
 
-def make_branches_plot(line, tag):
+def make_branches_plot(line, tag, file_to_hash):
     witness = get_witness_name(tag, line)
-    if not os.path.exists(witness):
+    testsuite_info = _get_testsuite_info(witness, file_to_hash)
+    if testsuite_info is None:
         return ""
-    img_small = _get_plot_img(witness)
-    img_large = _get_plot_img(witness, plot_labels=True)
+    img_small = _get_plot_img(witness, testsuite_info)
+    img_large = _get_plot_img(witness, testsuite_info, plot_labels=True)
     img_tag_small = '<img src="' + img_small + '" title="cov plot" />'
     img_tag_large = '<img src="' + img_large + '" title="cov plot" />'
     img_html = [
@@ -208,32 +323,21 @@ def make_branches_plot(line, tag):
     return imgstring
 
 
-def _get_plot_img(zipped_file, plot_labels=False) -> str:
-    """Extract the coverage-sequence file from the given zip and create the corresponding plot.
+def _get_plot_img(zipped_file, testsuite_info, plot_labels=False) -> str:
+    """Create the plot for the coverage sequence of the given test-suite info.
 
     :return str: image content for in-line HTML.
     """
-    with zipfile.ZipFile(zipped_file) as inp_zip:
-        sequence_file = next(
-            (n for n in inp_zip.namelist() if n.endswith(COVERAGE_SEQ_NAME)), None
+    coverage_sequence = testsuite_info.coverage_sequence
+    if coverage_sequence is None:
+        logging.warning(
+            "No sequence file %s found in %s, no coverage plot"
+            % (utils.COVERAGE_SEQ_NAME, zipped_file)
         )
-        # assert sequence_file is not None, "No sequence file %s found in %s" % (COVERAGE_SEQ_NAME, zipped_file)
-        if sequence_file is None:
-            logging.warning(
-                "No sequence file %s found in %s, no coverage plot"
-                % (COVERAGE_SEQ_NAME, zipped_file)
-            )
-            coverage_sequence = []
-        else:
-            with inp_zip.open(sequence_file) as seq_inp:
-                content = seq_inp.read().decode("utf-8")
-            test_data = json.loads(content)
-
-            if len(test_data) <= 1 or COV_ACCUMULATED not in test_data[0]:
-                logging.debug("Coverage.csv of %s incomplete", zipped_file)
-                return ""
-
-            coverage_sequence = [float(t[COV_ACCUMULATED]) for t in test_data]
+        coverage_sequence = []
+    elif not coverage_sequence:
+        logging.debug("Coverage.csv of %s incomplete", zipped_file)
+        return ""
 
     # Each sequence should start with a 0
     coverage_sequence = [0.0] + coverage_sequence
@@ -241,7 +345,7 @@ def _get_plot_img(zipped_file, plot_labels=False) -> str:
 
 
 def _create_plot_img(coverage_sequence: list, plot_labels=False) -> str:
-    """Creates a plot from the given sequence of coverage values.COVERAGE_SEQ_NAME
+    """Creates a plot from the given sequence of coverage values.
 
     :return str: image content for in-line HTML.
     """
@@ -282,55 +386,6 @@ def _create_plot_img(coverage_sequence: list, plot_labels=False) -> str:
     )
 
 
-def _replace_data_json(file_name: str, data_rows: dict) -> str:
-    new_content = list()
-    in_data_def = False
-    json_str = json.dumps(data_rows, sort_keys=True)
-    assert json_str[0] == "{", "json str starts with {}".format(json_str[:20])
-    assert json_str[-1] == "}", "json str stops with {}".format(json_str[-20:])
-    json_str = "{\n" + json_str[1:-1] + "\n};\n"
-    with open(file_name, "r") as inp:
-        for line in inp.readlines():
-            if line.startswith("const data = {"):
-                in_data_def = True
-                new_line = "const data = " + json_str
-                new_content.append(new_line)
-
-            if not in_data_def:
-                new_content.append(line)
-            elif line.startswith("}"):
-                in_data_def = False
-    return "".join(new_content)
-
-
-def _get_data_json(file_name: str) -> dict:
-    # This method gets the data json from the html
-    # through simple pattern matching.
-    # After the start of the expected data json is found in the given file,
-    # every line is considered until a line starting with '}' is encountered.
-    # If one of the considered lines starts with "rows: [" (with an arbitray number of whitespace),
-    # the array following "rows: " on the same line is considered.
-    # If the table generator changes that expected structure,
-    # it must be adjusted here.
-    in_data_def = False
-    with open(file_name, "r") as inp:
-        relevant_lines = list()
-        for line in inp:
-            if line.startswith("const data = {"):
-                in_data_def = True
-                relevant_lines.append("{")
-            elif in_data_def:
-                if line.startswith("}"):
-                    in_data_def = False
-                    relevant_lines.append("}")
-                    break
-                else:
-                    relevant_lines.append(line)
-        if relevant_lines:
-            return json.loads("".join(relevant_lines))
-        return None
-
-
 def _add_more_style(file_content: str) -> str:
     new_lines = []
     for line in file_content.split("\n"):
@@ -392,6 +447,57 @@ def parse(argv):
         default=True,
         help="Do not create plots",
     )
+    parser.add_argument(
+        "--testsuite-cache",
+        dest="testsuite_cache",
+        default=utils.TESTSUITE_CACHE_FILE,
+        help="Persistent cache of test-suite information, keyed by the hash"
+        " of the test suite. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--strict-existence-checks",
+        dest="strict_existence_checks",
+        action="store_true",
+        default=False,
+        help="Check the existence of witnesses, programs and file-store entries on disk"
+        " instead of using the index built from the hashmap and the file store",
+    )
+    parser.add_argument(
+        "--external-data",
+        dest="external_data",
+        action="store_true",
+        default=False,
+        help="Move the data of each table into a separate, content-addressed"
+        " and compressed JSON file in directory '%s' next to the table,"
+        " which is loaded by the table."
+        " The table then needs a web server that serves the compressed file"
+        " (configured by the .htaccess in that directory),"
+        " and cannot be opened from the local file system" % utils.TABLE_DATA_DIR,
+    )
+    parser.add_argument(
+        "--compress",
+        dest="compress",
+        action="store_true",
+        default=False,
+        help="Write the resulting HTML gzip-compressed to $file.gz and remove $file."
+        " Files with suffix .gz are always read and written compressed",
+    )
+    parser.add_argument(
+        "--compression-level",
+        dest="compression_level",
+        type=int,
+        choices=range(1, 10),
+        default=9,
+        help="gzip compression level for compressed HTML. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--compression-jobs",
+        dest="compression_jobs",
+        type=int,
+        default=4,
+        help="Number of files that are compressed and written in parallel."
+        " Default: %(default)s",
+    )
 
     args = parser.parse_args(argv)
     missing = [f for f in args.html_file + [args.hashmap_file] if not os.path.exists(f)]
@@ -419,6 +525,10 @@ def replace_links(row, hashmap, create_plots=True) -> Tuple[dict, dict]:
     # with the hash map
     task_name = row["href"][3:]
     task_name = urllib.parse.unquote(task_name)
+    # The validators of a row often refer to the same program and witness,
+    # so the URLs are only resolved once per row
+    url_cache = dict()
+    query_cache = dict()
     for idx, subsec in enumerate(row["results"]):
         is_validator = idx > 0
         # the data of each individual result set merged into a table
@@ -430,7 +540,15 @@ def replace_links(row, hashmap, create_plots=True) -> Tuple[dict, dict]:
                 if not v:
                     continue
                 if "___WITINSPDEL" in v:
-                    url = make_url(v, task_name, "WITINSPDEL", "inspect", hashmap)
+                    url = make_url(
+                        v,
+                        task_name,
+                        "WITINSPDEL",
+                        "inspect",
+                        hashmap,
+                        url_cache,
+                        query_cache,
+                    )
                     if url:
                         cell["html"] = "<a href='{}' target='_self'>inspect</a>".format(
                             url
@@ -440,7 +558,15 @@ def replace_links(row, hashmap, create_plots=True) -> Tuple[dict, dict]:
                     cell["href"] = None
                     cell["raw"] = None
                 elif "___WITVALIDEL___" in v:
-                    url = make_url(v, task_name, "WITVALIDEL", "validate", hashmap)
+                    url = make_url(
+                        v,
+                        task_name,
+                        "WITVALIDEL",
+                        "validate",
+                        hashmap,
+                        url_cache,
+                        query_cache,
+                    )
                     if url:
                         cell[
                             "html"
@@ -455,7 +581,7 @@ def replace_links(row, hashmap, create_plots=True) -> Tuple[dict, dict]:
                     cell["href"] = None
                     cell["raw"] = None
                 elif "___TESTSUITESIZE___" in v:
-                    testsuite_size = make_value_size(v, "TESTSUITESIZE", "")
+                    testsuite_size = make_value_size(v, "TESTSUITESIZE", "", hashmap)
                     if is_validator:
                         testsuite_sizes["validator"].append(testsuite_size)
                     else:
@@ -464,7 +590,7 @@ def replace_links(row, hashmap, create_plots=True) -> Tuple[dict, dict]:
                     cell["href"] = None
                     del testsuite_size  # don't use testsuite_size outside of this block
                 elif create_plots and "___COVPLOT___" in v:
-                    cell["html"] = make_branches_plot(v, "COVPLOT")
+                    cell["html"] = make_branches_plot(v, "COVPLOT", hashmap)
                     cell["href"] = None
                     cell["raw"] = None
     return (row, testsuite_sizes)
@@ -482,6 +608,8 @@ def main(argv=None):
     hashmap_file = args.hashmap_file
     global FILE_STORE_URL_PREFIX
     FILE_STORE_URL_PREFIX = args.file_store_url_prefix
+    global TESTSUITE_INFO_CACHE
+    TESTSUITE_INFO_CACHE = utils.TestSuiteInfoCache(args.testsuite_cache)
 
     try:
         logging.debug("Start reading hashmap")
@@ -492,18 +620,55 @@ def main(argv=None):
         logging.error("File %s no valid json: %s", hashmap_file, e)
         return 1
 
-    for filename in args.html_file:
-        logging.info("Replacer: Processing {}".format(filename))
-        new_content = handle_file(filename, hashmap, args.create_plots)
-        if new_content:
-            with open(filename, "w") as file_out:
-                file_out.write(new_content)
+    global EXISTENCE_INDEX
+    EXISTENCE_INDEX = ExistenceIndex(hashmap, strict=args.strict_existence_checks)
+
+    # Compression runs in threads (zlib releases the GIL),
+    # so that the next file is processed while the previous ones are compressed.
+    # The process pool is created before, so that no process is forked while
+    # these threads run.
+    with mp.Pool(processes=4) as pool, ThreadPoolExecutor(
+        max_workers=args.compression_jobs
+    ) as writer:
+        writes = collections.deque()
+        for filename in args.html_file:
+            logging.info("Replacer: Processing {}".format(filename))
+            new_content = handle_file(
+                filename, hashmap, args.create_plots, args.external_data, pool
+            )
+            if new_content:
+                writes.append(
+                    writer.submit(
+                        _write_file,
+                        filename,
+                        new_content,
+                        args.compress,
+                        args.compression_level,
+                    )
+                )
+                del new_content
+            # Finished writes are dropped, and at most one pending table per
+            # compression job is kept in memory
+            while writes and (writes[0].done() or len(writes) > args.compression_jobs):
+                writes.popleft().result()
+        for write in writes:
+            write.result()
     logging.info("Replacer: Done")
 
 
-def handle_file(filename, hashmap, create_plots=True):
+def _write_file(filename, new_content, compress, compression_level):
+    output_file = filename
+    if compress:
+        output_file = utils.compressed_table_name(filename)
+    utils.write_table(output_file, new_content, compression_level)
+    if output_file != filename:
+        os.remove(filename)
+    logging.debug("Wrote %s", output_file)
+
+
+def handle_file(filename, hashmap, create_plots=True, external_data=False, pool=None):
     logging.debug("Start getting data json from html")
-    data_json = _get_data_json(filename)
+    data_json = utils.get_data_json(filename)
     logging.debug("Done getting data json from html")
     if not data_json or not data_json["rows"]:
         logging.error(
@@ -512,18 +677,18 @@ def handle_file(filename, hashmap, create_plots=True):
         return None
 
     logging.debug("Start replacing template links in data json")
-    with mp.Pool(processes=4) as pool:
-        rep = functools.partial(
-            replace_links, hashmap=hashmap, create_plots=create_plots
-        )
-        rows, individual_testsuites_sizes = zip(*pool.map(rep, data_json["rows"]))
-        data_json["rows"] = rows
-        testsuite_sizes = {
-            "tool": [s for ts in individual_testsuites_sizes for s in ts["tool"]],
-            "validator": [
-                s for ts in individual_testsuites_sizes for s in ts["validator"]
-            ],
-        }
+    rep = functools.partial(replace_links, hashmap=hashmap, create_plots=create_plots)
+    if pool is None:
+        with mp.Pool(processes=4) as own_pool:
+            replaced_rows = own_pool.map(rep, data_json["rows"])
+    else:
+        replaced_rows = pool.map(rep, data_json["rows"])
+    rows, individual_testsuites_sizes = zip(*replaced_rows)
+    data_json["rows"] = rows
+    testsuite_sizes = {
+        "tool": [s for ts in individual_testsuites_sizes for s in ts["tool"]],
+        "validator": [s for ts in individual_testsuites_sizes for s in ts["validator"]],
+    }
     logging.debug("Done replacing template links in data json")
 
     # if there's no data for tool, there also won't be any data for validator, so this check
@@ -531,7 +696,7 @@ def handle_file(filename, hashmap, create_plots=True):
     if testsuite_sizes["tool"]:
         _add_testsuite_stats(data_json, testsuite_sizes)
     logging.debug("Start replacing data json in HTML")
-    new_content = _replace_data_json(filename, data_json)
+    new_content = utils.replace_data_json(filename, data_json, external_data)
     logging.debug("Done replacing data json in HTML")
     logging.debug("Start adding stylesheets in HTML")
     new_content = _add_more_style(new_content)
@@ -5,7 +5,7 @@
 # @description Creates the the nice HTML tables from the run results.
 # First it collects the results xmls and merges them, and then calls BenchExec's table generator on it.
 # Then it creates an HTML summarty page.
-# It removes scores from the html, merge jsons, create files, replaces links to the files, compresses the html files.
+# It removes scores from the html and compresses it, merge jsons, create files, and replaces links to the files.
 
 source $(dirname "$0")/../configure.sh
 
@@ -105,9 +105,12 @@ for PROP in $PROPERTIES; do
   rm ${VALIDATIONFILES};
   rm ${TABLEDEF};
   echo "Removing score row from table ...";
-  "$SCRIPT_DIR"/prepare-tables/mkRunProcessLocal-RemoveScoreStats.py --insitu ${FILERESULT}.table.html
-  # Remember to replace the links in the tables
-  echo "${FILERESULT}.table.html" >> ${HTMLFILESTOREPLACE};
+  # Compressed fast, as ReplaceLinks rewrites the table compressed with level 9
+  "$SCRIPT_DIR"/prepare-tables/mkRunProcessLocal-RemoveScoreStats.py --insitu --compress --compression-level 1 ${FILERESULT}.table.html
+  # Remember to replace the links in the tables (RemoveScoreStats skips broken tables)
+  if [ -e "${FILERESULT}.table.html.gz" ]; then
+    echo "${FILERESULT}.table.html.gz" >> ${HTMLFILESTOREPLACE};
+  fi
   date -Iseconds;
  done # for category
 done # for properties
@@ -180,35 +183,32 @@ OUTFILE="${VERIFIER}.results.${COMPETITION}.All";
                                        |& grep -v "\(No result for task\)\|\(A variable was not replaced in\)";
 rm ${TABLEDEFALL};
 echo "Removing score row from table ...";
-"$SCRIPT_DIR"/prepare-tables/mkRunProcessLocal-RemoveScoreStats.py --insitu ${RESULTSVERIFICATION}/${OUTFILE}.table.html
-# Remember to replace the links in the tables
-echo "${RESULTSVERIFICATION}/${OUTFILE}.table.html" >> ${HTMLFILESTOREPLACE};
+"$SCRIPT_DIR"/prepare-tables/mkRunProcessLocal-RemoveScoreStats.py --insitu --compress --compression-level 1 ${RESULTSVERIFICATION}/${OUTFILE}.table.html
+# Remember to replace the links in the tables (RemoveScoreStats skips broken tables)
+if [ -e "${RESULTSVERIFICATION}/${OUTFILE}.table.html.gz" ]; then
+  echo "${RESULTSVERIFICATION}/${OUTFILE}.table.html.gz" >> ${HTMLFILESTOREPLACE};
+fi
 date -Iseconds;
 
 # We need a unique name because of concurrency - use a temporary file.
 ALL_HASHES=$(mktemp --suffix=-comp.json)
 # For verification results
-WITNESS_VERIFIER_HASHES=`ls -dt ${RESULTSVERIFICATION}/${VERIFIER}.????-??-??_??-??-??.$HASHES_BASENAME | head -1`;
-echo "Merging hashes maps (${WITNESS_VERIFIER_HASHES}) ..."
-nice "$SCRIPT_DIR"/prepare-tables/mkRunProcessLocal-MergeJsons.py \
-    --output "$ALL_HASHES" \
-    "$WITNESS_VERIFIER_HASHES"
-date -Iseconds;
+WITNESS_HASHES=`ls -dt ${RESULTSVERIFICATION}/${VERIFIER}.????-??-??_??-??-??.$HASHES_BASENAME | head -1`;
 # For validation results
 for VALIDATION in $VALIDATORLIST; do
   VALIDATOR=${VALIDATION%-validate-*};
   VAL="val_$VALIDATOR"
-  echo "Processing $VALIDATION ...";
   FOUNDRESULTS=`find ${RESULTSVALIDATION} -maxdepth 1 -name ${VALIDATION}-${VERIFIER}.????-??-??_??-??-??.$HASHES_BASENAME`
   if [ -n "$FOUNDRESULTS" ]; then
-    WITNESS_VALIDATOR_HASHES=`ls -dt ${RESULTSVALIDATION}/${VALIDATION}-${VERIFIER}.????-??-??_??-??-??.$HASHES_BASENAME | head -1`;
-    echo "Merging hashes maps (${WITNESS_VALIDATOR_HASHES}) ..."
-    nice "$SCRIPT_DIR"/prepare-tables/mkRunProcessLocal-MergeJsons.py \
-        --output "$ALL_HASHES" \
-        "$ALL_HASHES" "$WITNESS_VALIDATOR_HASHES"
-    date -Iseconds;
+    WITNESS_HASHES="$WITNESS_HASHES `ls -dt ${RESULTSVALIDATION}/${VALIDATION}-${VERIFIER}.????-??-??_??-??-??.$HASHES_BASENAME | head -1`";
   fi
 done
+echo "Merging hashes maps (${WITNESS_HASHES}) ..."
+nice "$SCRIPT_DIR"/prepare-tables/mkRunProcessLocal-MergeJsons.py \
+    --compact \
+    --output "$ALL_HASHES" \
+    $WITNESS_HASHES
+date -Iseconds;
 echo "Creating file store ..."
 nice "$SCRIPT_DIR"/prepare-tables/mkRunProcessLocal-CreateFileStore.py \
     --output "$HASHDIR_BASENAME" \
@@ -217,16 +217,19 @@ nice "$SCRIPT_DIR"/prepare-tables/mkRunProcessLocal-CreateFileStore.py \
 date -Iseconds;
 
 
+# The tables are already compressed, ReplaceLinks reads and writes them compressed
 echo "Replacing witness links ..."
-"$SCRIPT_DIR"/prepare-tables/mkRunProcessLocal-ReplaceLinks.py --no-plots $(cat "$HTMLFILESTOREPLACE") --hashmap "$ALL_HASHES" --file-store-url-prefix "${FILE_STORE_URL_PREFIX}"
-date -Iseconds;
-
-echo "Compressing HTML tables ...";
-for FILE in `cat ${HTMLFILESTOREPLACE}`; do
-  gzip -9 --force $FILE;
-done
+REPLACELINKSOPTIONS="--no-plots";
+if [[ -n "$TABLE_EXTERNAL_DATA" ]]; then
+  # Move the table data into separate, content-addressed files (set in $USER_CONFIG).
+  # The tables then only work on a web server that allows the .htaccess of tableData.
+  REPLACELINKSOPTIONS="$REPLACELINKSOPTIONS --external-data";
+fi
+if [ -s "$HTMLFILESTOREPLACE" ]; then
+  "$SCRIPT_DIR"/prepare-tables/mkRunProcessLocal-ReplaceLinks.py $REPLACELINKSOPTIONS $(cat "$HTMLFILESTOREPLACE") --hashmap "$ALL_HASHES" --file-store-url-prefix "${FILE_STORE_URL_PREFIX}"
+fi
 date -Iseconds;
-rm ${HTMLFILESTOREPLACE};
+rm -f ${HTMLFILESTOREPLACE};
 rm ${ALL_HASHES};
 
 
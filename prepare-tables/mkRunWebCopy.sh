@@ -34,6 +34,10 @@ rsync -axzq --dirs --no-recursive --include="$RESULT_ID.*.xml.bz2" --exclude="*"
 rsync -axzq --dirs --no-recursive --include="$RESULT_ID.*.zip"     --exclude="*" "$SOURCE" "$TARGET"
 rsync -axzq --dirs --no-recursive --include="$RESULT_ID.*.txt"     --exclude="*" "$SOURCE" "$TARGET"
 rsync -axzq --dirs --no-recursive --include="$RESULT_ID.*.json"    --exclude="*" "$SOURCE" "$TARGET"
+if [ -d "$RESULTSVERIFICATION/tableData" ]; then
+  # Table data is content-addressed and compressed: existing files never change
+  rsync -axq --ignore-existing "$RESULTSVERIFICATION/tableData/" "${TARGET}tableData/"
+fi
 
 echo "... $RESULTSVALIDATION"
 SOURCE="$PATHPREFIX/$RESULTSVALIDATION/"
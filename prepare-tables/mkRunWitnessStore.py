@@ -1,13 +1,19 @@
+import argparse
+import collections
+import datetime
 import sys
 from os import makedirs
 import os
-from os.path import isfile, getmtime
+import textwrap
 import time
+import sqlite3
 from xml.etree import ElementTree as etree
+import gzip
 import json
 import re
-import zipfile
 import multiprocessing as mp
+import yaml
+from functools import partial
 import utils
 import _logging as logging
 
@@ -15,17 +21,47 @@ GRAPHML_TAG = "{http://graphml.graphdrawing.org/xmlns}graphml"
 METADATA_TAG = "test-metadata"
 GRAPH_TAG = "{http://graphml.graphdrawing.org/xmlns}graph"
 DATA_TAG = "{http://graphml.graphdrawing.org/xmlns}data"
+NODE_TAG = "{http://graphml.graphdrawing.org/xmlns}node"
+EDGE_TAG = "{http://graphml.graphdrawing.org/xmlns}edge"
 RESULTS_VERIFIED_DIR = "results-verified"
-
+SNIFF_SIZE = 4096
+"""Number of bytes read to determine the content type of a file in the store."""
+
+WITNESS_DB = "witnessStore.sqlite"
+STATISTICS_FILE = "witnessStoreStatistics.json"
+DB_COMMIT_INTERVAL = 10000
+"""Number of added witnesses after which the witness database is committed."""
+PROGRESS_INTERVAL = 10000
+"""Number of processed files after which the progress is reported."""
 JSON_DIR = "witnessInfoByHash"
+LIST_DIR = "witnessListByProgramHash"
+LIST_JSON_DIR = "witnessListByProgramHashJSON"
+
+TESTSUITE_INFO_CACHE = None
 
 
-def is_graphml_file(file_name):
-    return isfile(file_name) and file_name.endswith(".graphml")
+def _is_yaml_witness(head):
+    for line in head.splitlines():
+        line = line.strip()
+        if line and not line.startswith((b"#", b"---")):
+            return line.startswith((b"- entry_type:", b"- metadata:"))
+    return False
 
 
-def is_zip_file(file_name):
-    return isfile(file_name) and file_name.endswith(".zip")
+def sniff_content_type(head):
+    """Return the content type of a file from its first bytes:
+    'gz', 'zip', 'graphml', 'xml', 'yaml' (a YAML witness), or None.
+    """
+    if head.startswith(b"\x1f\x8b"):
+        return "gz"
+    if head.startswith((b"PK\x03\x04", b"PK\x05\x06")):
+        return "zip"
+    text = head.lstrip(b"\xef\xbb\xbf \t\r\n")
+    if text.startswith(b"<"):
+        return "graphml" if b"<graphml" in text else "xml"
+    if _is_yaml_witness(text):
+        return "yaml"
+    return None
 
 
 def parse_xml(xml_content):
@@ -33,17 +69,57 @@ def parse_xml(xml_content):
     return tree_root
 
 
-def parse_graphml(graphml_file):
-    with open(graphml_file) as inp:
-        tree_root = parse_xml(inp.read())
-
-    if GRAPHML_TAG != tree_root.tag:
-        raise etree.ParseError(
-            "Graphml file '{}' is invalid: "
-            "Its root element is not named '{}'.".format(graphml_file, GRAPHML_TAG)
-        )
-
-    return tree_root
+def read_graph_data(graphml_file):
+    """Return the graph-level data of the given GraphML file (name or binary file
+    object) as dict.
+
+    The file is parsed incrementally and parsing stops at the first node or edge,
+    so that memory and time do not depend on the size of the witness.
+    """
+    graph_data = dict()
+    depth = 0
+    for event, elem in etree.iterparse(graphml_file, events=("start", "end")):
+        if event == "start":
+            depth += 1
+            if depth == 1 and GRAPHML_TAG != elem.tag:
+                raise etree.ParseError(
+                    "Graphml file '{}' is invalid: "
+                    "Its root element is not named '{}'.".format(
+                        getattr(graphml_file, "name", graphml_file), GRAPHML_TAG
+                    )
+                )
+            if elem.tag in (NODE_TAG, EDGE_TAG):
+                break
+            continue
+        depth -= 1
+        if elem.tag == GRAPH_TAG:
+            break
+        # Only the data children of the graph, not those of the graphml root
+        if elem.tag == DATA_TAG and depth == 2:
+            graph_data[elem.get("key")] = elem.text
+    return graph_data
+
+
+def read_yaml_witness_data(yaml_file):
+    """Return the witness-info data of the given YAML witness,
+    from the metadata of its first entry.
+    """
+    entries = yaml.safe_load(yaml_file)
+    metadata = entries[0]["metadata"]
+    task = metadata.get("task") or dict()
+    input_file_hashes = task.get("input_file_hashes") or dict()
+    witness_data = {
+        "witness-type": entries[0].get("entry_type"),
+        "producer": (metadata.get("producer") or dict()).get("name"),
+        "specification": task.get("specification"),
+        "creationtime": metadata.get("creation_time"),
+        "programhash": next(iter(input_file_hashes.values()), None),
+    }
+    creation_time = witness_data["creationtime"]
+    if isinstance(creation_time, datetime.date):
+        # YAML parses timestamps, but records hold ISO 8601 strings like GraphML
+        witness_data["creationtime"] = creation_time.isoformat()
+    return {k: str(v) for k, v in witness_data.items() if v is not None}
 
 
 def parse_test_metadata(test_metadata_content):
@@ -67,7 +143,14 @@ def get_if_exists(dictionary, key):
         return ""
 
 
-def mk_witness_info(witness_file):
+def mk_witness_info(witness_file, json_tree=True):
+    """Create the witness-info record of the given witness.
+
+    :param json_tree: whether to also add the record to the JSON tree.
+    :return: tuple of the hash of the file and its witness-info record,
+             where the record is None if the file is no witness,
+             or None if the file could not be read.
+    """
     try:
         witness_info = _get_witness_info(witness_file)
     except Exception as e:
@@ -76,51 +159,65 @@ def mk_witness_info(witness_file):
             "Exception for %s (size: %s kB): %s", witness_file, witness_size, e
         )
     else:
-        if witness_info:
+        if witness_info and json_tree:
             write_witness_info(witness_info)
+        return _get_store_hash(witness_file), witness_info
+    return None
 
 
 def _get_witness_info(witness_file):
-    if not is_graphml_file(witness_file) and not is_zip_file(witness_file):
-        return None
-    witness_info = dict()
-    witness_info["witness-file"] = witness_file
-    witness_info["witness-sha256"] = re.sub(
-        "^.*\/([^\/]*).(graphml|zip)", "\\1", witness_file
-    )
-    witness_info["witness-size"] = os.path.getsize(witness_file)
-
-    # Extract witness-info record from witness
-    if is_graphml_file(witness_file):
-        try:
-            witness_xml = parse_graphml(witness_file)
-            for data in witness_xml.find(GRAPH_TAG).findall(DATA_TAG):
-                witness_info[data.get("key")] = data.text
-        except etree.ParseError as e:
-            witness_info["error-xmlparsing"] = "File produces XML parsing error."
-        except OverflowError as e:
-            logging.error("Error parsing file '{}': {}".format(witness_file, e.msg))
-    if is_zip_file(witness_file):
-        # Extract info from metadata.xml in the zip archive
-        with zipfile.ZipFile(witness_file) as zfile:
-            for finfo in zfile.infolist():
-                if finfo.filename.endswith("metadata.xml"):
-                    try:
-                        with zfile.open(finfo) as ifile:
-                            metadata_xml = parse_test_metadata(ifile.read())
-                        for data in metadata_xml:
-                            witness_info[data.tag] = data.text
-
-                    except etree.ParseError as e:
-                        witness_info[
-                            "error-xmlparsing"
-                        ] = "File produces XML parsing error."
-                    # There's only one metadata.xml, so stop after we found it
-                    break
-        witness_info["witness-type"] = "test-suite"
-        witness_info["witness-number-of-tests"] = utils.get_file_number_in_zip(
-            witness_file
-        )
+    with open(witness_file, "rb") as inp:
+        content_type = sniff_content_type(inp.read(SNIFF_SIZE))
+        inp.seek(0)
+        witness = inp
+        if content_type == "gz":
+            witness = gzip.GzipFile(fileobj=inp)
+            content_type = sniff_content_type(witness.read(SNIFF_SIZE))
+            witness.seek(0)
+            if content_type == "zip":
+                content_type = None
+        if content_type in (None, "xml") and witness_file.endswith(".graphml"):
+            # Broken GraphML witness, recorded with its parsing error
+            content_type = "graphml"
+        if content_type not in ("graphml", "zip", "yaml"):
+            return None
+        stat = os.fstat(inp.fileno())
+        witness_info = dict()
+        witness_info["witness-file"] = witness_file
+        # The file store is content-addressed, so the name is the hash of the witness
+        witness_info["witness-sha256"] = _get_store_hash(witness_file)
+        witness_info["witness-size"] = stat.st_size
+
+        # Extract witness-info record from witness
+        if content_type == "graphml":
+            try:
+                witness_info.update(read_graph_data(witness))
+            except etree.ParseError as e:
+                witness_info["error-xmlparsing"] = "File produces XML parsing error."
+            except OverflowError as e:
+                logging.error("Error parsing file '{}': {}".format(witness_file, e.msg))
+        if content_type == "yaml":
+            try:
+                witness_info.update(read_yaml_witness_data(witness))
+            except (yaml.YAMLError, LookupError, TypeError, AttributeError) as e:
+                witness_info["error-yamlparsing"] = "File is no valid YAML witness."
+        if content_type == "zip":
+            # Extract info from metadata.xml in the zip archive
+            testsuite_info = TESTSUITE_INFO_CACHE.get(
+                witness, witness_info["witness-sha256"]
+            )
+            if testsuite_info.metadata is not None:
+                try:
+                    metadata_xml = parse_test_metadata(testsuite_info.metadata)
+                    for data in metadata_xml:
+                        witness_info[data.tag] = data.text
+
+                except etree.ParseError as e:
+                    witness_info[
+                        "error-xmlparsing"
+                    ] = "File produces XML parsing error."
+            witness_info["witness-type"] = "test-suite"
+            witness_info["witness-number-of-tests"] = testsuite_info.number_of_tests
 
     if "programhash" in witness_info.keys():
         if len(get_if_exists(witness_info, "programhash")) == 64:
@@ -139,12 +236,177 @@ def _get_witness_info(witness_file):
         ] = "Key 'specification' longer than 100 characters."
     if "creationtime" not in witness_info.keys():
         witness_info["creationtime"] = (
-            time.strftime("%Y-%m-%dT%H:%M %Z", time.localtime(getmtime(witness_file)))
+            time.strftime("%Y-%m-%dT%H:%M %Z", time.localtime(stat.st_mtime))
             + " (comp)"
         )
     return witness_info
 
 
+class WitnessDatabase:
+    """Witness-info records of all witnesses in one SQLite database.
+
+    The records are indexed by witness hash, program hash, producer and type,
+    so that the web frontend can query a single file.
+    """
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self._connection = sqlite3.connect(db_file)
+        self._connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS witnesses (
+                witness_sha256 TEXT PRIMARY KEY,
+                program_sha256 TEXT,
+                producer TEXT,
+                witness_type TEXT,
+                info TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS witnesses_program
+                ON witnesses (program_sha256);
+            CREATE INDEX IF NOT EXISTS witnesses_producer ON witnesses (producer);
+            CREATE INDEX IF NOT EXISTS witnesses_type ON witnesses (witness_type);
+            CREATE TABLE IF NOT EXISTS non_witnesses (
+                sha256 TEXT PRIMARY KEY
+            );
+            """
+        )
+
+    def hashes(self):
+        """Return the set of all witness hashes in the database."""
+        rows = self._connection.execute("SELECT witness_sha256 FROM witnesses")
+        return {row[0] for row in rows}
+
+    def non_witness_hashes(self):
+        """Return the set of hashes of all store entries that are no witnesses."""
+        rows = self._connection.execute("SELECT sha256 FROM non_witnesses")
+        return {row[0] for row in rows}
+
+    def add_non_witness(self, store_hash):
+        """Record that the store entry with the given hash is no witness."""
+        self._connection.execute(
+            "INSERT OR IGNORE INTO non_witnesses VALUES (?)", (store_hash,)
+        )
+
+    def add(self, witness_info) -> bool:
+        """Add the given witness-info record, if its witness is not yet known.
+
+        :return: whether the record was added.
+        """
+        cursor = self._connection.execute(
+            "INSERT OR IGNORE INTO witnesses VALUES (?, ?, ?, ?, ?)",
+            (
+                witness_info["witness-sha256"],
+                witness_info.get("program-sha256"),
+                witness_info.get("producer"),
+                witness_info.get("witness-type"),
+                json.dumps(witness_info, sort_keys=True),
+            ),
+        )
+        return cursor.rowcount > 0
+
+    def infos(self):
+        """Yield the witness-info records of all witnesses in the database."""
+        for row in self._connection.execute("SELECT info FROM witnesses"):
+            yield json.loads(row[0])
+
+    def commit(self):
+        self._connection.commit()
+
+    def close(self):
+        self._connection.commit()
+        self._connection.close()
+
+
+_SIZE_BUCKETS = (
+    (10**3, "< 1 kB"),
+    (10**4, "< 10 kB"),
+    (10**5, "< 100 kB"),
+    (10**6, "< 1 MB"),
+    (10**7, "< 10 MB"),
+    (10**8, "< 100 MB"),
+)
+
+
+def _get_size_bucket(size):
+    for limit, bucket in _SIZE_BUCKETS:
+        if size < limit:
+            return bucket
+    return ">= 100 MB"
+
+
+class WitnessStatistics:
+    """Running aggregates over the witness-info records of the witness store:
+    per-producer and per-type counts, byte totals, a size histogram and error counts,
+    and the duplicates of witnesses across the hashmaps of the results.
+    """
+
+    def __init__(self, statistics=None):
+        self.statistics = statistics or {
+            "witnesses": 0,
+            "bytes": 0,
+            "producers": dict(),
+            "types": dict(),
+            "sizes": dict(),
+            "errors": dict(),
+        }
+
+    @classmethod
+    def load(cls, statistics_file):
+        """Return the statistics stored in the given file, or None if it is missing."""
+        try:
+            with open(statistics_file) as inp:
+                return cls(json.load(inp))
+        except FileNotFoundError:
+            return None
+
+    def add(self, witness_info):
+        size = witness_info.get("witness-size", 0)
+        statistics = self.statistics
+        statistics["witnesses"] += 1
+        statistics["bytes"] += size
+        producer = statistics["producers"].setdefault(
+            witness_info.get("producer") or "unknown", {"witnesses": 0, "bytes": 0}
+        )
+        producer["witnesses"] += 1
+        producer["bytes"] += size
+        witness_type = witness_info.get("witness-type") or "unknown"
+        statistics["types"][witness_type] = statistics["types"].get(witness_type, 0) + 1
+        bucket = _get_size_bucket(size)
+        statistics["sizes"][bucket] = statistics["sizes"].get(bucket, 0) + 1
+        for key in witness_info:
+            if key.startswith("error-"):
+                statistics["errors"][key] = statistics["errors"].get(key, 0) + 1
+
+    def count_duplicates(self, hashmap_files, witness_hashes):
+        """Count how often each of the given witnesses is referenced
+        by the given hashmaps (`*fileHashes.json*`).
+
+        Identical witnesses of several runs are stored only once,
+        so only the hashmaps show how often a witness was produced.
+        """
+        references = collections.Counter()
+        for hashmap_file in hashmap_files:
+            logging.debug("Counting witnesses of %s", hashmap_file)
+            with utils.open_json(hashmap_file) as inp:
+                references.update(
+                    sha_hash
+                    for _, sha_hash in utils.iter_json_object(inp)
+                    if sha_hash in witness_hashes
+                )
+        self.statistics["duplicates"] = {
+            "hashmaps": len(hashmap_files),
+            "references": sum(references.values()),
+            "duplicate-references": sum(n - 1 for n in references.values()),
+            "duplicated-witnesses": sum(1 for n in references.values() if n > 1),
+        }
+
+    def write(self, statistics_file):
+        tmp_file = statistics_file + ".tmp"
+        with open(tmp_file, "w") as outp:
+            json.dump(self.statistics, outp, indent=utils.JSON_INDENT, sort_keys=True)
+        os.replace(tmp_file, statistics_file)
+
+
 def write_witness_info(witness_info):
     # Add witness info to directory 'witnessInfoByHash'
     json_file = os.path.join(JSON_DIR, witness_info["witness-sha256"] + ".json")
@@ -157,9 +419,7 @@ def write_witness_info(witness_info):
 
     # Add witness info to directory 'witnessListByProgramHash/<hash>'
     if "program-sha256" in witness_info.keys():
-        witness_dir = os.path.join(
-            "witnessListByProgramHash", witness_info["program-sha256"]
-        )
+        witness_dir = os.path.join(LIST_DIR, witness_info["program-sha256"])
         if not os.path.exists(witness_dir):
             if os.path.lexists(witness_dir):
                 # witness_dir is broken symlink. Remove it.
@@ -187,52 +447,262 @@ def _yield_witnesses_in_dir(witnesses):
             )
 
 
-def mk_witness_list(program_dir):
-    witness_list = list(
-        _yield_witnesses_in_dir(
-            [
-                os.path.join(curr_dir, witness_file)
-                for curr_dir, _, witness_files in os.walk(program_dir)
-                for witness_file in witness_files
-            ]
-        )
-    )
-    json_file = (
-        "witnessListByProgramHashJSON" + "/" + re.sub(".*\/", "", program_dir) + ".json"
+def _get_store_hash(file_name):
+    return os.path.basename(file_name).split(".", 1)[0]
+
+
+def _list_witness_infos():
+    """Return the set of witness hashes that already have a witness-info record."""
+    return {
+        entry.name[: -len(".json")]
+        for entry in os.scandir(JSON_DIR)
+        if entry.name.endswith(".json")
+    }
+
+
+def _get_unlisted_program_dirs():
+    """Return the program directories without a witness list,
+    e.g., because a previous run was interrupted.
+    """
+    listed_hashes = {
+        entry.name[: -len(".json")]
+        for entry in os.scandir(LIST_JSON_DIR)
+        if entry.name.endswith(".json")
+    }
+    return [
+        entry.path
+        for entry in os.scandir(LIST_DIR)
+        if entry.is_dir() and entry.name not in listed_hashes
+    ]
+
+
+def _write_json_list(records, outp, compact=False):
+    """Write the given records as JSON array, one record at a time.
+
+    Without compact, the output equals json.dump(list(records), outp, indent=2).
+    """
+    count = 0
+    outp.write("[")
+    for count, record in enumerate(records, start=1):
+        if compact:
+            outp.write("," if count > 1 else "")
+            outp.write(json.dumps(record, separators=(",", ":")))
+        else:
+            outp.write(",\n" if count > 1 else "\n")
+            outp.write(textwrap.indent(json.dumps(record, indent=2), "  "))
+    outp.write("]" if compact or not count else "\n]")
+
+
+def mk_witness_list(program_dir, compact=False):
+    """Write the witness list of the given program directory.
+
+    :return: the time (of time.monotonic) before the directory was listed,
+             so the list contains all witnesses linked into it before that time.
+    """
+    listed_at = time.monotonic()
+    witnesses = _yield_witnesses_in_dir(
+        os.path.join(curr_dir, witness_file)
+        for curr_dir, _, witness_files in os.walk(program_dir)
+        for witness_file in witness_files
     )
+    json_file = LIST_JSON_DIR + "/" + re.sub(".*\/", "", program_dir) + ".json"
+    # Readers of the list never see a partially written file
+    tmp_file = json_file + ".tmp"
     try:
-        with open(json_file, "w") as json_file_obj:
-            json.dump(witness_list, json_file_obj, indent=2)
+        with open(tmp_file, "w") as json_file_obj:
+            _write_json_list(witnesses, json_file_obj, compact)
+        os.replace(tmp_file, json_file)
     except IOError as e:
         logging.error("%s", e)
+    return listed_at
+
+
+def parse(argv):
+    parser = argparse.ArgumentParser(
+        description="Update the witness store from the file store."
+    )
+    parser.add_argument(
+        "--db",
+        dest="db_file",
+        default=WITNESS_DB,
+        help="SQLite witness database to update. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--testsuite-cache",
+        dest="testsuite_cache",
+        default=utils.TESTSUITE_CACHE_FILE,
+        help="persistent cache of test-suite information, keyed by the hash"
+        " of the test suite. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--statistics",
+        dest="statistics_file",
+        default=STATISTICS_FILE,
+        help="file to write the statistics of the witness store to."
+        " Default: %(default)s",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        # Respects the CPU affinity, e.g., the cpuset of a cluster job
+        default=len(os.sched_getaffinity(0)),
+        help="number of worker processes. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=64,
+        help="number of files sent to a worker process at once. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--json-tree",
+        dest="json_tree",
+        action="store_true",
+        default=False,
+        help="also export the witness-info records as JSON tree"
+        " (directories {}, {} and {})".format(JSON_DIR, LIST_DIR, LIST_JSON_DIR),
+    )
+    parser.add_argument(
+        "--compact-lists",
+        dest="compact_lists",
+        action="store_true",
+        default=False,
+        help="write the witness lists of the JSON tree without indentation",
+    )
+    parser.add_argument(
+        "--full-rebuild",
+        dest="full_rebuild",
+        action="store_true",
+        default=False,
+        help="regenerate the witness lists of all programs,"
+        " not only of those that got new witnesses",
+    )
+    parser.add_argument(
+        "--hashmaps",
+        nargs="+",
+        default=[],
+        help="hashmaps of the results (*fileHashes.json*)"
+        " to count duplicate witnesses in",
+    )
+    return parser.parse_args(argv)
 
 
-def main():
+def _log_progress(count, start_time, what):
+    if count % PROGRESS_INTERVAL == 0:
+        logging.info(
+            "Processed %s %s (%.0f/s)",
+            count,
+            what,
+            count / max(time.monotonic() - start_time, 1e-6),
+        )
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    args = parse(argv)
     logging.init(logging.DEBUG, "mkRunWitnessStore")
+    # Created before the worker processes, which inherit it
+    global TESTSUITE_INFO_CACHE
+    TESTSUITE_INFO_CACHE = utils.TestSuiteInfoCache(args.testsuite_cache)
     logging.info("Updating witness info records and program-to-witness map ...")
-    # parallel = concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count()*2)
-    if not os.path.exists(JSON_DIR):
-        os.mkdir(JSON_DIR)
-    with mp.Pool(processes=8) as parallel:
-        parallel.map(
-            mk_witness_info,
+    witness_db = WitnessDatabase(args.db_file)
+    # The store is content-addressed, so witnesses with an existing record
+    # are skipped before they are parsed
+    known_hashes = witness_db.hashes()
+    statistics = WitnessStatistics.load(args.statistics_file)
+    if statistics is None or statistics.statistics["witnesses"] != len(known_hashes):
+        logging.info("Statistics are missing or outdated, recomputing from database")
+        statistics = WitnessStatistics()
+        for witness_info in witness_db.infos():
+            statistics.add(witness_info)
+    if args.json_tree:
+        if not os.path.exists(JSON_DIR):
+            os.mkdir(JSON_DIR)
+        makedirs(LIST_DIR, exist_ok=True)
+        makedirs(LIST_JSON_DIR, exist_ok=True)
+        known_hashes &= _list_witness_infos()
+    logging.info("%s witness info records exist already", len(known_hashes))
+    # Store entries that are no witnesses are not opened again
+    non_witness_hashes = witness_db.non_witness_hashes()
+    logging.info("%s store entries are no witnesses", len(non_witness_hashes))
+    # Maps each program with new witnesses to the time its last witness was added
+    new_programs = dict()
+    write_witness_list = partial(mk_witness_list, compact=args.compact_lists)
+    with mp.Pool(processes=args.workers) as parallel:
+        early_lists = None
+        if args.json_tree:
+            # Witness lists that do not depend on new witnesses are written
+            # while the witness info records are created
+            if args.full_rebuild:
+                early_program_dirs = [
+                    e.path for e in os.scandir(LIST_DIR) if e.is_dir()
+                ]
+            else:
+                early_program_dirs = _get_unlisted_program_dirs()
+            logging.info(
+                "Writing witness lists of %s program(s) in the background",
+                len(early_program_dirs),
+            )
+            early_lists = parallel.map_async(
+                write_witness_list, early_program_dirs, chunksize=args.chunk_size
+            )
+
+        witness_infos = parallel.imap_unordered(
+            partial(mk_witness_info, json_tree=args.json_tree),
             (
-                os.path.join(curr_dir, f)
-                for curr_dir, _, files in os.walk("fileByHash")
-                for f in files
+                store_path
+                for store_name, store_path in utils.iter_store("fileByHash")
+                if _get_store_hash(store_name) not in known_hashes
+                and _get_store_hash(store_name) not in non_witness_hashes
             ),
+            chunksize=args.chunk_size,
         )
-
+        added = 0
+        start_time = time.monotonic()
+        for count, result in enumerate(witness_infos, start=1):
+            _log_progress(count, start_time, "file(s)")
+            if not result:
+                continue
+            store_hash, witness_info = result
+            if not witness_info:
+                witness_db.add_non_witness(store_hash)
+                continue
+            if witness_db.add(witness_info):
+                statistics.add(witness_info)
+                added += 1
+                if added % DB_COMMIT_INTERVAL == 0:
+                    witness_db.commit()
+            if "program-sha256" in witness_info:
+                # The witness was linked into the program directory by the worker
+                new_programs[witness_info["program-sha256"]] = time.monotonic()
+        if args.hashmaps:
+            statistics.count_duplicates(args.hashmaps, witness_db.hashes())
+        witness_db.close()
+        statistics.write(args.statistics_file)
+        logging.info("Added %s witness(es) to %s", added, args.db_file)
+
+        if not args.json_tree:
+            return
+        # Raises the exceptions of failed witness lists
+        listed_at = dict(zip(early_program_dirs, early_lists.get()))
         logging.info("Updating program-to-witness map in JSON files ...")
-        # parallel = concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count()*2)
-        parallel.map(
-            mk_witness_list,
-            (
-                os.path.join(curr_dir, d)
-                for curr_dir, program_dirs, _ in os.walk("witnessListByProgramHash")
-                for d in program_dirs
-            ),
+        # Lists written in the background after the last new witness of their program
+        # was added are up to date
+        program_dirs = [
+            os.path.join(LIST_DIR, h)
+            for h, added_at in new_programs.items()
+            if listed_at.get(os.path.join(LIST_DIR, h), added_at) <= added_at
+        ]
+        logging.info(
+            "Writing witness lists of %s program(s), %s already up to date",
+            len(program_dirs),
+            len(new_programs) - len(program_dirs),
         )
+        for _ in parallel.imap_unordered(
+            write_witness_list, program_dirs, chunksize=args.chunk_size
+        ):
+            pass
 
 
 if __name__ == "__main__":
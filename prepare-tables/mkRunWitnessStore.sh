@@ -10,17 +10,18 @@ source $(dirname "$0")/../configure.sh
 cd ${PATHPREFIX}
 
 date -Iseconds;
-nice python3 $(dirname "$0")/mkRunWitnessStore.py
+nice python3 $(dirname "$0")/mkRunWitnessStore.py --json-tree \
+  --hashmaps ${RESULTSVERIFICATION}/*${HASHES_BASENAME}*
 date -Iseconds;
 
 echo "Prepare maps ...";
 set +e -x
-zip --quiet -r -u "$HASHDIR_BASENAME.zip" "$HASHDIR_BASENAME"
-zip --quiet -r -u witnessInfoByHash.zip witnessInfoByHash
-zip --quiet -r -u witnessListByProgramHashJSON.zip witnessListByProgramHashJSON
+python3 $(dirname "$0")/packArchive.py --immutable "$HASHDIR_BASENAME.zip" "$HASHDIR_BASENAME"
+python3 $(dirname "$0")/packArchive.py --immutable witnessInfoByHash.zip witnessInfoByHash
+python3 $(dirname "$0")/packArchive.py witnessListByProgramHashJSON.zip witnessListByProgramHashJSON
 
 echo "Copy witness store to web server ...";
-for ARCHIVE in ${PATHPREFIX}/*.zip; do
+for ARCHIVE in ${PATHPREFIX}/*.zip ${PATHPREFIX}/witnessStore.sqlite ${PATHPREFIX}/witnessStoreStatistics.json; do
   rsync -txp --inplace ${ARCHIVE} dbeyer@www-comp.sosy.ifi.lmu.de:/srv/web/data/${TARGETDIR}/${YEAR}/results/
 done
 set -e +x
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+This script packs a directory into a zip archive incrementally,
+as replacement for `zip -r -u <archive> <directory>`.
+
+A manifest of the members of the archive (`<archive>.manifest.json.gz`)
+is kept next to the archive, so that only files that are not yet in the archive
+are compared and appended. With `--immutable`, files that are already in the archive
+are not even compared, which is valid for content-addressed directories
+like `fileByHash` and `witnessInfoByHash`.
+If a file changed, its new version is appended as well,
+and only the central directory of the archive drops the old version,
+so the archive stays unchanged up to its old central directory.
+Once more than half of the archive is taken by such replaced members,
+the archive is compacted.
+Like `zip -u`, members whose file was removed are kept.
+Files that are already compressed (e.g., zips and gz files) are stored
+without recompression.
+
+Example usage:
+```
+prepare-tables/packArchive.py --immutable fileByHash.zip fileByHash
+```
+"""
+
+import argparse
+import json
+import os
+import sys
+import warnings
+import zipfile
+
+import _logging as logging
+import utils
+
+STORED_SUFFIXES = (".zip", ".gz", ".bz2", ".xz", ".zst", ".png", ".jpg")
+"""Suffixes of already-compressed files, which are stored without recompression."""
+
+
+def get_manifest_name(archive):
+    return archive + ".manifest.json.gz"
+
+
+def _iter_files(directory):
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                yield from _iter_files(entry.path)
+            elif entry.is_file():
+                yield entry
+
+
+def _get_member_name(path):
+    return os.path.normpath(path).replace(os.sep, "/")
+
+
+def _get_compress_type(member_name):
+    if member_name.endswith(STORED_SUFFIXES):
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def _read_manifest(archive):
+    """Return the manifest of the given archive.
+
+    If the manifest is missing or does not belong to the archive,
+    it is recreated from the central directory of the archive.
+    """
+    if not os.path.exists(archive):
+        return {"archive-size": 0, "dead-bytes": 0, "members": dict()}
+    try:
+        with utils.open_json(get_manifest_name(archive)) as inp:
+            manifest = json.load(inp)
+        if manifest["archive-size"] == os.path.getsize(archive):
+            return manifest
+    except FileNotFoundError:
+        pass
+    logging.info("Manifest of %s is missing or outdated, reading archive", archive)
+    with zipfile.ZipFile(archive) as inp_zip:
+        members = {
+            info.filename: [info.file_size, None]
+            for info in inp_zip.infolist()
+            if not info.is_dir()
+        }
+        data_end = inp_zip.start_dir
+        # Estimate, replaced members are not in the central directory
+        data_size = sum(
+            30 + len(info.filename.encode()) + len(info.extra) + info.compress_size
+            for info in inp_zip.infolist()
+        )
+    return {
+        "archive-size": os.path.getsize(archive),
+        "dead-bytes": max(0, data_end - data_size),
+        "members": members,
+    }
+
+
+def _write_manifest(archive, members, dead_bytes):
+    manifest = {
+        "archive-size": os.path.getsize(archive),
+        "dead-bytes": dead_bytes,
+        "members": members,
+    }
+    tmp_file = get_manifest_name(archive) + ".tmp.gz"
+    with utils.open_json(tmp_file, "wt") as outp:
+        json.dump(manifest, outp, separators=(",", ":"))
+    os.replace(tmp_file, get_manifest_name(archive))
+
+
+def _append(archive, new_files):
+    """Append the given files to the given archive.
+
+    Files that replace members of the archive are appended, too,
+    and the replaced members are only dropped from the central directory.
+
+    :return: number of bytes of the replaced members.
+    """
+    replaced_bytes = 0
+    with zipfile.ZipFile(archive, "a") as out_zip:
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", "Duplicate name", UserWarning)
+            for member_name, path in new_files:
+                replaced = out_zip.NameToInfo.get(member_name)
+                if replaced:
+                    replaced_bytes += replaced.compress_size
+                out_zip.write(path, member_name, _get_compress_type(member_name))
+        out_zip.filelist = [
+            info
+            for info in out_zip.filelist
+            if out_zip.NameToInfo[info.filename] is info
+        ]
+    return replaced_bytes
+
+
+def _compact(archive):
+    """Rewrite the given archive without the data of replaced members."""
+    tmp_file = archive + ".tmp"
+    with zipfile.ZipFile(tmp_file, "w") as out_zip:
+        with zipfile.ZipFile(archive) as inp_zip:
+            for info in inp_zip.infolist():
+                out_zip.writestr(info, inp_zip.read(info))
+    os.replace(tmp_file, archive)
+
+
+def pack(archive, source_dir, immutable=False):
+    """Add all new and changed files of the given directory to the given archive."""
+    manifest = _read_manifest(archive)
+    members = manifest["members"]
+    dead_bytes = manifest.get("dead-bytes", 0)
+    new_files = list()
+    for entry in _iter_files(source_dir):
+        member_name = _get_member_name(entry.path)
+        known = members.get(member_name)
+        if known and immutable:
+            continue
+        stat = entry.stat()
+        if known and known[0] == stat.st_size and known[1] in (None, stat.st_mtime_ns):
+            known[1] = stat.st_mtime_ns
+            continue
+        new_files.append((member_name, entry.path))
+        members[member_name] = [stat.st_size, stat.st_mtime_ns]
+
+    logging.info("Adding %s file(s) of %s to %s", len(new_files), source_dir, archive)
+    if new_files or not os.path.exists(archive):
+        dead_bytes += _append(archive, new_files)
+    if dead_bytes > os.path.getsize(archive) / 2:
+        logging.info(
+            "Replaced members take %s bytes, compacting %s", dead_bytes, archive
+        )
+        _compact(archive)
+        dead_bytes = 0
+    _write_manifest(archive, members, dead_bytes)
+
+
+def parse(argv):
+    parser = argparse.ArgumentParser(
+        description="Pack a directory into a zip archive incrementally."
+    )
+    parser.add_argument(
+        "--immutable",
+        action="store_true",
+        default=False,
+        help="do not compare files that are already in the archive,"
+        " for content-addressed directories",
+    )
+    parser.add_argument("archive", help="zip archive to update")
+    parser.add_argument("source_dir", help="directory to pack")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    args = parse(argv)
+    logging.init(logging.INFO, "pack-archive")
+
+    if not os.path.isdir(args.source_dir):
+        logging.error("Directory %s does not exist", args.source_dir)
+        return 1
+    pack(args.archive, args.source_dir, args.immutable)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
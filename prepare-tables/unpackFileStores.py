@@ -30,14 +30,15 @@ Recommended:
         To install with pip, run `pip install progressbar2`.
 """
 
-#%%
+# %%
 import argparse
-import json
-import gzip
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 from pathlib import Path
 import _logging as logging
 import os
 import sys
+import utils
 
 try:
     import progressbar
@@ -51,60 +52,107 @@ except ModuleNotFoundError:
 else:
     progressbar.streams.wrap_stderr()
 
-#%%
+# %%
 FILE_STORE = Path("fileByHash")
 
 
-def eager_search(store_hash, target_suffix):
-    # The globbing in this method is a big bottleneck,
-    # so we should not use this, if possible
-    logging.debug("Using glob to find correct file")
-    store_files = list(FILE_STORE.glob(f"{store_hash}*"))
-    if len(store_files) > 1:
-        logging.info(f"Hash duplicate: {store_hash}")
-        store_files = [f for f in store_files if f.name.endswith(target_suffix)]
-    if len(store_files) == 0:
+LINK_WORKERS = 8
+"""Number of threads that create links in parallel."""
+
+LINK_BATCH_SIZE = 10000
+"""Number of links that are handed to the threads at once."""
+
+
+def index_store(store_dir):
+    """Return a dict that maps each hash to the paths of the files with that hash
+    in the given store, from one scan of the store (flat or sharded layout)."""
+    store_index = dict()
+    for store_name, store_path in utils.iter_store(store_dir):
+        store_hash = store_name.split(".")[0]
+        store_index.setdefault(store_hash, list()).append(store_path)
+    return store_index
+
+
+def find_source(store_index, store_hash, target_suffix):
+    store_files = store_index.get(store_hash)
+    if not store_files:
         return None
-    assert len(store_files) == 1
+    if len(store_files) > 1:
+        logging.debug(f"Hash duplicate: {store_hash}")
+        for store_file in store_files:
+            if store_file.endswith("." + target_suffix):
+                return store_file
     return store_files[0]
 
 
+def _link(link):
+    source, target = link
+    try:
+        os.link(source, target)
+    except FileExistsError:
+        logging.info(f"File {str(target)} already exists. File from store is ignored.")
+
+
+def _digest(text):
+    # A 64-bit digest of a path or hash is much smaller than the text itself
+    return hashlib.blake2b(str(text).encode(), digest_size=8).digest()
+
+
+def _link_batch(pool, links):
+    for _ in pool.map(_link, links):
+        pass
+
+
 def unpack(hashes, output_dir):
-    for target, store_hash in progressbar.progressbar(hashes.items()):
-        target = output_dir / Path(target)
-        if target.exists():
-            logging.info(
-                f"File {str(target)} already exists. File from store is ignored."
-            )
-            continue
-        target_suffix = target.name.split(".")[-1]
-        # Guessing the file name right is tremendously faster than globbing for the hash.
-        # First guess: hash + suffix
-        source = FILE_STORE / (store_hash + "." + target_suffix)
-        if not source.exists():
-            # Second guess: just the hash
-            source = FILE_STORE / store_hash
-        if not source.exists():
-            # Uncomment this to also search for other store_hash patterns
-            # This is very expensive!
-            # source = eager_search(store_hash, target_suffix)
-            source = None
+    """Unpack the given (path, hash) pairs from the file store into output_dir.
+
+    The pairs are consumed as a stream and linked in batches,
+    so memory stays bounded regardless of the number of pairs.
+    If a path occurs multiple times, only its first occurrence is used,
+    and a warning is logged for each later occurrence with a different hash.
+    """
+    store_index = index_store(FILE_STORE)
+    logging.info(f"Indexed {len(store_index)} hashes in {FILE_STORE}.")
+
+    seen_targets = dict()
+    directories = set()
+    links = list()
+    with ThreadPoolExecutor(max_workers=LINK_WORKERS) as pool:
+        for target, store_hash in progressbar.progressbar(hashes):
+            target = output_dir / Path(target)
+            target_key = _digest(target)
+            hash_key = _digest(store_hash)
+            if target_key in seen_targets:
+                if seen_targets[target_key] != hash_key:
+                    logging.warning(
+                        f"Conflicting hashes for {target}, keeping the first one."
+                        f" Ignored hash: {store_hash}"
+                    )
+                continue
+            seen_targets[target_key] = hash_key
+            target_suffix = target.name.split(".")[-1]
+            source = find_source(store_index, store_hash, target_suffix)
             if not source:
                 logging.warning(
                     f"Missing file in {FILE_STORE} for {target}. Expected hash: {store_hash}"
                 )
                 continue
-        target.parent.mkdir(parents=True, exist_ok=True)
-        os.link(source, target)
+            if target.parent not in directories:
+                target.parent.mkdir(parents=True, exist_ok=True)
+                directories.add(target.parent)
+            links.append((source, target))
+            if len(links) >= LINK_BATCH_SIZE:
+                _link_batch(pool, links)
+                links = list()
+        _link_batch(pool, links)
 
 
-def parse(json_file):
-    if json_file.name.endswith(".gz"):
-        file_open = gzip.open
-    else:
-        file_open = open
-    with file_open(json_file) as inp:
-        return json.load(inp)
+def iter_hashes(json_files):
+    """Yield the (path, hash) pairs of the given hashmap files, one at a time."""
+    for json_file in json_files:
+        logging.debug(f"Reading {json_file}")
+        with utils.open_json(json_file) as inp:
+            yield from utils.iter_json_object(inp)
 
 
 def main(argv=None):
@@ -119,13 +167,9 @@ def main(argv=None):
     opts.output_dir = Path(opts.output_dir)
     logging.init(logging.DEBUG, "unpack-file-stores")
 
-    hashes = dict()
-    logging.info(f"Parsing {len(opts.file)} file(s).")
-    for f in progressbar.progressbar(opts.file):
-        f = Path(f)
-        hashes.update(parse(f))
-    logging.info("Parsing finished. Unpacking store.")
-    unpack(hashes, output_dir=opts.output_dir)
+    logging.info(f"Unpacking store for {len(opts.file)} file(s).")
+    unpack(iter_hashes(opts.file), output_dir=opts.output_dir)
+    logging.info("Unpacking finished.")
 
 
 # %%
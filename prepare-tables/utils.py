@@ -1,7 +1,13 @@
+import collections
 import fnmatch
 
 from math import floor, log10
+import gzip
+import hashlib
+import json
 import os
+import re
+import sqlite3
 import yaml
 import logging
 import zipfile
@@ -22,20 +28,424 @@ def is_on_blacklist(filename):
     return any(fnmatch.fnmatch(os.path.basename(filename), b) for b in _BLACKLIST)
 
 
-def get_file_number_in_zip(zipped_file) -> int:
-    """Return the list of files in this zip"""
-    try:
-        with zipfile.ZipFile(zipped_file) as inp_zip:
-            return len(
-                [
-                    x
-                    for x in inp_zip.namelist()
-                    if x.endswith(".xml") and not x.endswith("metadata.xml")
-                ]
+TABLE_DATA_DIR = "tableData"
+"""Directory, relative to an HTML table, that contains externalized table data."""
+
+_DATA_DEF_START = "const data = "
+_EXTERNAL_DATA_DEF = (
+    _DATA_DEF_START + "JSON.parse((function (request) {{ "
+    'request.open("GET", "{}", false); request.send(); return request.responseText; '
+    "}})(new XMLHttpRequest()));\n"
+)
+_TABLE_DATA_HTACCESS = """RewriteEngine On
+# Serve the compressed table data <hash>.json.gz for requests to <hash>.json,
+# so that the browser decompresses it
+RewriteCond %{REQUEST_FILENAME} !-f
+RewriteRule ^([0-9a-f]{64}\\.json)$ $1.gz [L]
+RemoveType .gz
+AddType application/json .json
+AddEncoding gzip .gz
+"""
+_EXTERNAL_DATA_URL = re.compile(
+    "^"
+    + _DATA_DEF_START
+    + r'JSON\.parse\(.*"('
+    + TABLE_DATA_DIR
+    + r'/[0-9a-f]{64}\.json)"'
+)
+
+
+def compressed_table_name(file_name: str) -> str:
+    """Return the name of the gzip-compressed version of the given HTML table."""
+    if file_name.endswith(".gz"):
+        return file_name
+    return file_name + ".gz"
+
+
+def open_table(file_name: str):
+    """Open the given HTML table for reading. Tables named '*.gz' are compressed."""
+    if file_name.endswith(".gz"):
+        return gzip.open(file_name, "rt", encoding="utf-8")
+    return open(file_name, "r", encoding="utf-8")
+
+
+def write_table(file_name: str, content: str, compresslevel=9):
+    """Write the given content to the given HTML table.
+
+    Tables with suffix '.gz' are written gzip-compressed with the given level.
+    The table is replaced atomically, so a table can be rewritten in place.
+    """
+    tmp_file = file_name + ".tmp"
+    with open(tmp_file, "wb") as outp:
+        if file_name.endswith(".gz"):
+            with gzip.GzipFile(
+                filename=file_name, mode="wb", compresslevel=compresslevel, fileobj=outp
+            ) as gz_outp:
+                gz_outp.write(content.encode("utf-8"))
+        else:
+            outp.write(content.encode("utf-8"))
+    os.replace(tmp_file, file_name)
+
+
+def get_data_json(file_name: str) -> dict:
+    """Return the data json of the given HTML table of BenchExec's table generator.
+
+    The data json is found through simple pattern matching:
+    After the start of the expected data json ("const data = {") is found,
+    every line is considered until a line starting with '}' is encountered.
+    If the data json was moved to an external file, the external file is read.
+    If the table generator changes that expected structure,
+    it must be adjusted here.
+    """
+    in_data_def = False
+    with open_table(file_name) as inp:
+        relevant_lines = list()
+        for line in inp:
+            if line.startswith(_DATA_DEF_START + "{"):
+                in_data_def = True
+                relevant_lines.append("{")
+            elif in_data_def:
+                if line.startswith("}"):
+                    in_data_def = False
+                    relevant_lines.append("}")
+                    break
+                else:
+                    relevant_lines.append(line)
+            elif line.startswith(_DATA_DEF_START):
+                external_data = _EXTERNAL_DATA_URL.match(line)
+                if external_data:
+                    return _read_external_data(file_name, external_data.group(1))
+        if relevant_lines:
+            return json.loads("".join(relevant_lines))
+        return None
+
+
+def replace_data_json(file_name: str, data_json: dict, external_data=False) -> str:
+    """Return the content of the given HTML table with its data json replaced.
+
+    If external_data is set, the data json is written to a content-addressed,
+    compressed file in TABLE_DATA_DIR next to the HTML table,
+    and the HTML table loads the data from there.
+    """
+    if external_data:
+        data_def = _write_external_data(file_name, data_json)
+    else:
+        json_str = json.dumps(data_json, sort_keys=True)
+        assert json_str[0] == "{", "json str starts with {}".format(json_str[:20])
+        assert json_str[-1] == "}", "json str stops with {}".format(json_str[-20:])
+        data_def = _DATA_DEF_START + "{\n" + json_str[1:-1] + "\n};\n"
+    new_content = list()
+    in_data_def = False
+    with open_table(file_name) as inp:
+        for line in inp:
+            if line.startswith(_DATA_DEF_START + "{"):
+                in_data_def = True
+                new_content.append(data_def)
+            elif not in_data_def and _EXTERNAL_DATA_URL.match(line):
+                new_content.append(data_def)
+                continue
+
+            if not in_data_def:
+                new_content.append(line)
+            elif line.startswith("}"):
+                in_data_def = False
+    return "".join(new_content)
+
+
+def _read_external_data(file_name: str, data_url: str) -> dict:
+    data_file = os.path.join(os.path.dirname(file_name), data_url + ".gz")
+    with gzip.open(data_file, "rt") as inp:
+        return json.load(inp)
+
+
+def _write_external_data(file_name: str, data_json: dict) -> str:
+    # The data file is named by the hash of its content,
+    # so unchanged data keeps its name and is never written (or uploaded) again.
+    # The table requests the uncompressed name, and the web server serves
+    # the compressed file with 'Content-Encoding: gzip' according to the .htaccess
+    # of the directory. Opened from the local file system, the table has no data.
+    content = json.dumps(data_json, sort_keys=True).encode("utf-8")
+    data_url = TABLE_DATA_DIR + "/" + hashlib.sha256(content).hexdigest() + ".json"
+    data_file = os.path.join(os.path.dirname(file_name), data_url + ".gz")
+    if not os.path.exists(data_file):
+        os.makedirs(os.path.dirname(data_file), exist_ok=True)
+        htaccess_file = os.path.join(os.path.dirname(data_file), ".htaccess")
+        if not os.path.exists(htaccess_file):
+            with open(htaccess_file, "w") as outp:
+                outp.write(_TABLE_DATA_HTACCESS)
+        tmp_file = data_file + ".tmp"
+        with open(tmp_file, "wb") as outp:
+            with gzip.GzipFile(
+                filename="", mode="wb", compresslevel=9, fileobj=outp, mtime=0
+            ) as gz_outp:
+                gz_outp.write(content)
+        os.replace(tmp_file, data_file)
+    return _EXTERNAL_DATA_DEF.format(data_url)
+
+
+TESTSUITE_METADATA_NAME = "metadata.xml"
+COVERAGE_SEQ_NAME = "results.json"
+COV_ACCUMULATED = "Coverage (accumulated)"
+TESTSUITE_CACHE_FILE = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "competition-scripts",
+    "testSuiteInfoByHash.sqlite",
+)
+"""Default location of the TestSuiteInfoCache, outside of all published directories.
+The cache is keyed by content hash, so it can be shared by all competitions."""
+
+TestSuiteInfo = collections.namedtuple(
+    "TestSuiteInfo", ["number_of_tests", "metadata", "coverage_sequence"]
+)
+"""Information about a test-suite zip.
+
+'metadata' is the content of the test suite's metadata.xml, or None if there is none.
+'coverage_sequence' is the sequence of accumulated coverage values of the test suite's
+results.json. It is None if there is no results.json,
+and it is empty if the results.json is incomplete.
+"""
+
+
+def inspect_test_suite(zipped_file) -> TestSuiteInfo:
+    """Return the TestSuiteInfo of the given test-suite zip.
+
+    The zip is opened once and its central directory is read once,
+    for all of the extracted information.
+    """
+    number_of_tests = 0
+    metadata = None
+    coverage_sequence = None
+    with zipfile.ZipFile(zipped_file) as inp_zip:
+        metadata_info = None
+        sequence_info = None
+        for finfo in inp_zip.infolist():
+            if finfo.filename.endswith(TESTSUITE_METADATA_NAME):
+                if metadata_info is None:
+                    metadata_info = finfo
+            elif finfo.filename.endswith(".xml"):
+                number_of_tests += 1
+            elif sequence_info is None and finfo.filename.endswith(COVERAGE_SEQ_NAME):
+                sequence_info = finfo
+
+        if metadata_info is not None:
+            metadata = inp_zip.read(metadata_info).decode("utf-8", errors="replace")
+        if sequence_info is not None:
+            try:
+                test_data = json.loads(inp_zip.read(sequence_info).decode("utf-8"))
+            except ValueError as e:
+                logging.warning(
+                    "Invalid %s in %s: %s", COVERAGE_SEQ_NAME, zipped_file, e
+                )
+                test_data = []
+            if len(test_data) <= 1 or COV_ACCUMULATED not in test_data[0]:
+                coverage_sequence = []
+            else:
+                coverage_sequence = [float(t[COV_ACCUMULATED]) for t in test_data]
+    return TestSuiteInfo(number_of_tests, metadata, coverage_sequence)
+
+
+class TestSuiteInfoCache:
+    """Persistent cache of TestSuiteInfo, keyed by the SHA-256 hash of the zip.
+
+    The cache is backed by an SQLite database,
+    so that it can be shared by multiple processes and across runs.
+    """
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self._memo = dict()
+        self._connection = None
+        self._connection_pid = None
+
+    def _connect(self):
+        # SQLite connections must not be shared with forked worker processes
+        if self._connection is None or self._connection_pid != os.getpid():
+            os.makedirs(os.path.dirname(self.cache_file) or ".", exist_ok=True)
+            self._connection = sqlite3.connect(self.cache_file, timeout=60)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS testsuite_info "
+                "(sha256 TEXT PRIMARY KEY, info TEXT NOT NULL)"
             )
-    except FileNotFoundError as e:
-        # print('Error: Zip file does not exist.')
-        return 0
+            self._connection_pid = os.getpid()
+        return self._connection
+
+    def get(self, zipped_file, zip_sha256=None) -> TestSuiteInfo:
+        """Return the TestSuiteInfo of the given test-suite zip.
+
+        If no hash is given, the zip is inspected without using the cache.
+        """
+        if not zip_sha256:
+            return inspect_test_suite(zipped_file)
+        if zip_sha256 in self._memo:
+            return self._memo[zip_sha256]
+
+        connection = self._connect()
+        row = connection.execute(
+            "SELECT info FROM testsuite_info WHERE sha256 = ?", (zip_sha256,)
+        ).fetchone()
+        if row:
+            info = TestSuiteInfo(*json.loads(row[0]))
+        else:
+            info = inspect_test_suite(zipped_file)
+            with connection:
+                connection.execute(
+                    "INSERT OR IGNORE INTO testsuite_info VALUES (?, ?)",
+                    (zip_sha256, json.dumps(info)),
+                )
+        self._memo[zip_sha256] = info
+        return info
+
+
+SHARDED_STORE_MARKER = ".sharded"
+"""File in a file store that marks the store as sharded."""
+
+_STORE_HTACCESS = """RewriteEngine On
+# Resolve URLs of the flat layout (<hash>.<suffix>) to the sharded layout
+RewriteCond %{REQUEST_FILENAME} !-f
+RewriteRule ^(([0-9a-f]{2})([0-9a-f]{2})[0-9a-f]{60}[^/]*)$ $2/$3/$1 [L]
+"""
+
+
+def is_sharded_store(store_dir) -> bool:
+    """Return whether the given file store uses the sharded layout.
+
+    In the flat layout, all entries are stored as <store_dir>/<hash>.<suffix>.
+    In the sharded layout, entries are stored as <store_dir>/ab/cd/<hash>.<suffix>,
+    where 'ab' and 'cd' are the first two pairs of characters of the hash.
+    """
+    return os.path.exists(os.path.join(store_dir, SHARDED_STORE_MARKER))
+
+
+def mark_sharded_store(store_dir):
+    """Mark the given file store as sharded.
+
+    A rewrite configuration for the web server is added to the store,
+    so that published URLs of the flat layout keep working.
+    """
+    with open(os.path.join(store_dir, ".htaccess"), "w") as outp:
+        outp.write(_STORE_HTACCESS)
+    with open(os.path.join(store_dir, SHARDED_STORE_MARKER), "w"):
+        pass
+
+
+def get_store_path(store_name, sharded=False) -> str:
+    """Return the path of the given file-store entry, relative to the file store."""
+    if not sharded:
+        return store_name
+    return store_name[0:2] + "/" + store_name[2:4] + "/" + store_name
+
+
+def resolve_store_file(store_dir, store_name):
+    """Return the path of the given entry in the given file store,
+    or None if the entry does not exist. Both layouts are considered,
+    so that partially migrated stores are supported.
+    """
+    for sharded in (True, False):
+        store_file = os.path.join(store_dir, get_store_path(store_name, sharded))
+        if os.path.exists(store_file):
+            return store_file
+    return None
+
+
+def iter_store(store_dir):
+    """Yield (name, path) of all entries in the given file store, for both layouts."""
+    try:
+        entries = os.scandir(store_dir)
+    except FileNotFoundError:
+        return
+    # The entries are streamed, so that huge flat stores are not listed in memory
+    with entries:
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir(follow_symlinks=False) and len(entry.name) == 2:
+                for shard in os.scandir(entry.path):
+                    for e in os.scandir(shard.path):
+                        yield e.name, e.path
+            else:
+                yield entry.name, entry.path
+
+
+def list_store(store_dir) -> set:
+    """Return the names of all entries in the given file store, for both layouts."""
+    return {store_name for store_name, _ in iter_store(store_dir)}
+
+
+def open_json(json_file, mode="rt"):
+    """Open the given JSON file. Files with suffix '.gz' are gzip-compressed."""
+    if str(json_file).endswith(".gz"):
+        return gzip.open(json_file, mode, encoding="utf-8")
+    return open(json_file, mode, encoding="utf-8")
+
+
+_JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_JSON_DELIMITER = re.compile(r"[ \t\n\r,:\]}]")
+
+
+def iter_json_object(inp, chunk_size=1024 * 1024):
+    """Yield the (key, value) pairs of the JSON object in the given text stream.
+
+    The stream is read and decoded in chunks, so that memory stays bounded
+    by the size of the largest single value, not by the size of the object.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    eof = False
+
+    def _fill():
+        nonlocal buffer, pos, eof
+        chunk = inp.read(chunk_size)
+        if not chunk:
+            eof = True
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+    def _next_token():
+        nonlocal pos
+        while True:
+            pos = _JSON_WHITESPACE.match(buffer, pos).end()
+            if pos < len(buffer) or eof:
+                break
+            _fill()
+        if pos >= len(buffer):
+            raise json.JSONDecodeError("Unexpected end of data", buffer, pos)
+        return buffer[pos]
+
+    def _expect(token):
+        nonlocal pos
+        if _next_token() != token:
+            raise json.JSONDecodeError("Expecting '%s'" % token, buffer, pos)
+        pos += 1
+
+    def _decode_value():
+        nonlocal pos
+        _next_token()
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                _fill()
+                continue
+            if not eof and not _JSON_DELIMITER.search(buffer, end):
+                # The value may continue in the next chunk (e.g., a number)
+                _fill()
+                continue
+            pos = end
+            return value
+
+    _expect("{")
+    if _next_token() == "}":
+        return
+    while True:
+        key = _decode_value()
+        _expect(":")
+        yield key, _decode_value()
+        if _next_token() == "}":
+            return
+        _expect(",")
 
 
 def round_to_sig_numbers(x: float, n: int) -> float: